@@ -34,6 +34,8 @@
  * Commands and arguments:   
  *   0 (0)  NOP           No operation, just getting status.
  * 100 (1)  ECHO          args: one byte to put in the echo registor
+ * 102 (0)  GET_RATES     puts the bus rates we can run at (a rate mask) in the echo registor
+ * 103 (1)  SET_RATE      args: rate code(1) -- moves to that bus rate once the reply is out
  *   1 (3)  NEO_RESET     NeoPixel Reset Args: Color(3)
  *   2 (9)  NEO_SINGLE    NeoPixel Single: C1(3), C2(3), Index(1), C1-Wait(1), C2-Wait(1)
  *   3 (3)  NEO_SOLID     NeoPixel Solid Args: Color(3)
@@ -177,7 +179,7 @@ int neo_anim_iside = 0;
 
 // Comm Bus Stuff
 void on_receive(byte *, int);
-CommBus bus(NODE_ADDRESS, on_receive);
+CommBus bus(NODE_ADDRESS, on_receive, RATE_MASK_BASE);  // Can't take bytes while the pixels update, so no faster rates.
 bool cmd_pending = false;
 uint8_t cmd_bytes[16];
 int cmd_bytes_len = 0;
@@ -253,6 +255,14 @@ bool process_command() {
                 echo_reg = cmd_bytes[1];
             }
             return true;
+        case CMD_GET_RATES: {
+                echo_reg = bus.rate_mask();
+            }
+            return true;
+        case CMD_SET_RATE: {
+                bus.set_rate(cmd_bytes[1]);
+            }
+            return true;
         case CMD_NEO_RESET: {
                 // Arguments:
                 // cmd, c-r, c-b, c-b
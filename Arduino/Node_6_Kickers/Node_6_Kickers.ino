@@ -24,6 +24,11 @@
  * Commands and arguments:   
  * 00      NOP            No operation, just getting status.
  * 100     ECHO           args: one byte to put in the echo registor
+ * 102     GET_RATES      puts the bus rates we can run at (a rate mask) in the echo registor
+ * 103     SET_RATE       args: rate code(1) -- moves to that bus rate once the reply is out
+ * 105     GET_CFG_HASH   args: byte index(1) -- puts that byte of the config hash in the echo registor
+ * 106     SET_CFG_HASH   args: hash_low(1), hash_high(1)
+ * 107     STAMPS         args: on(1) -- if replies end with the latest closure and its age.  Off at power up.
  * 20      COILS_PWM      args: mask(1), pwm(1), ontime(1), resttime(1)
  * 21      COILS_ENABLE   args: mask(1), enabled(1)
  * 22      COILS_TRIGGER  args: mask(1), energized(1)
@@ -86,6 +91,8 @@
  *   Byte 3:   Bit pattern of current switch conditions.
  *   Byte 4:   Switch counts for inputs  0 and  1
  *   Byte 5:   Switch counts for input   2
+ *   Then, if STAMPS is on: the latest closure (switch index, 0xFF if none yet),
+ *   and how many ms ago it was (up to 255).
  * 
  * A switch count byte has the following bit pattern:  bbbb-aaaa were "bbbb" is the
  * count for the highered number switch, and "aaaa" is the switch count for the lowered
@@ -120,6 +127,10 @@
 // Define the commands
 #define CMD_NOP               0 
 #define CMD_ECHO            100
+#define CMD_GET_CFG_HASH    105   // Config hash, a byte at a time, so the pi can skip sending config we already have.
+#define CMD_SET_CFG_HASH    106
+#define CMD_STAMPS          107   // Closure stamps at the end of the reply, on or off.
+#define CMD_SAFE_STATE      101   // Usually broadcast.  Disables all coils and lamps.
 #define CMD_COILS_PWM        20
 #define CMD_COILS_ENABLE     21
 #define CMD_COILS_TRIGGER    22
@@ -166,6 +177,8 @@ uint32_t debounce_on[] = {1000, 1000, 1000, 1000};
 uint32_t debounce_off[] = {2000, 2000, 2000, 2000};
 uint32_t debounce_t0[] = {0, 0, 0, 0};
 uint8_t switch_counts[] = {0, 0, 0, 0};
+uint8_t last_closure = 0xFF;    // Index of the most recent closure, 0xFF if none yet
+uint32_t last_closure_t = 0;    // millis() when it was confirmed
 uint8_t switch_states[] = {SW_READY, SW_READY, SW_READY, SW_READY};
 uint8_t switch_bits = 0;
 
@@ -197,6 +210,8 @@ int cmd_bytes_len = 0;
 uint16_t cmd_count = 0;
 uint16_t err_count = 0;
 uint8_t echo_reg = 0;
+uint16_t cfg_hash = 0;   // Hash of the config the pi last sent us.  Zero after power up.
+bool stamps_on = false;  // If replies end with the latest closure and its age.  Only if the pi asks.
 
 // Timmer Fucntions...
 uint32_t t0_timmer;
@@ -250,6 +265,32 @@ bool process_command() {
                 echo_reg = cmd_bytes[1];
             }
             return true;
+        case CMD_GET_RATES: {
+                echo_reg = bus.rate_mask();
+            }
+            return true;
+        case CMD_SET_RATE: {
+                bus.set_rate(cmd_bytes[1]);
+            }
+            return true;
+        case CMD_GET_CFG_HASH: {
+                if (cmd_bytes[1] == 0) echo_reg = cfg_hash & 0x00FF;
+                else echo_reg = (cfg_hash >> 8) & 0x00FF;
+            }
+            return true;
+        case CMD_SET_CFG_HASH: {
+                cfg_hash = ((uint16_t) cmd_bytes[2] << 8) | cmd_bytes[1];
+            }
+            return true;
+        case CMD_STAMPS: {
+                stamps_on = cmd_bytes[1] != 0;
+            }
+            return true;
+        case CMD_SAFE_STATE: {
+                for(int i = 0; i < NCOILS; i++) coil_enable[i] = false;
+                for(int i = 0; i < NLAMPS; i++) lamp_enable[i] = false;
+            }
+            return true;
         case CMD_COILS_PWM: {
                 int mask = cmd_bytes[1];
                 int pwm = cmd_bytes[2];
@@ -395,7 +436,18 @@ void load_response() {
     response[4] = ((switch_counts[1] << 4) & 0x00F0) | (switch_counts[0] & 0x000F);
     response[5] = ((switch_counts[3] << 4) & 0x00F0) | (switch_counts[2] & 0x000F);
 
-    bus.set_response(response, 6);
+    // If the Pi asked for them, the most recent closure, and how many ms ago
+    // it was (up to 255), so the Pi can tell when it happened.  The age changes
+    // every ms, so it is left out when the bus decides if a delta poll has
+    // anything new.
+    if (stamps_on) {
+        uint32_t age = millis() - last_closure_t;
+        response[6] = last_closure;
+        response[7] = age > 255 ? 255 : age;
+        bus.set_response(response, 8, 1);
+    } else {
+        bus.set_response(response, 6);
+    }
 }
 
 
@@ -488,6 +540,8 @@ void get_inputs() {
                         switch_states[i] = SW_ACTIVE;
                         x = x | ibit;
                         switch_counts[i]++;
+                        last_closure = i;
+                        last_closure_t = millis();
                         lamp_trig_pending[i] = true;
                         coil_trig_pending[i] = true;
                     }
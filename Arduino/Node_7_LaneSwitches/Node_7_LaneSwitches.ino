@@ -18,6 +18,11 @@
  * Commands and arguments:   
  * 00      NOP            No operation, just getting status.
  * 100     ECHO           args: one byte to put in the echo registor
+ * 102     GET_RATES      puts the bus rates we can run at (a rate mask) in the echo registor
+ * 103     SET_RATE       args: rate code(1) -- moves to that bus rate once the reply is out
+ * 105     GET_CFG_HASH   args: byte index(1) -- puts that byte of the config hash in the echo registor
+ * 106     SET_CFG_HASH   args: hash_low(1), hash_high(1)
+ * 107     STAMPS         args: on(1) -- if replies end with the latest closure and its age.  Off at power up.
  * 30      DEBOUNCE       args: tunit_low(1), tunit_high(1) 
  * 31      DB_BANK        args: bank(1), mask(1), tunit_low(1), tunit_high(1)
  * 32      CLEAR_COUNTS   args: none
@@ -49,6 +54,8 @@
  *   Byte 10:   Switch counts for inputs 10 and 11
  *   Byte 11:   Switch counts for inputs 12 and 13
  *   Byte 12:   Switch counts for inputs 14 and 15
+ *   Then, if STAMPS is on: the latest closure (switch index, 0xFF if none yet),
+ *   and how many ms ago it was (up to 255).
  * 
  * A switch count byte has the following bit pattern:  bbbb-aaaa were "bbbb" is the
  * count for the highered number switch, and "aaaa" is the switch count for the lowered
@@ -84,6 +91,9 @@
 // Define the commands
 #define CMD_NOP               0
 #define CMD_ECHO            100 
+#define CMD_GET_CFG_HASH    105   // Config hash, a byte at a time, so the pi can skip sending config we already have.
+#define CMD_SET_CFG_HASH    106
+#define CMD_STAMPS          107   // Closure stamps at the end of the reply, on or off.
 #define CMD_DEBOUNCE         30
 #define CMD_DB_BANK          31
 #define CMD_CLEAR_COUNTS     32
@@ -107,6 +117,8 @@ uint32_t debounce_off[] = {5000, 5000, 5000, 5000, 5000, 5000, 5000, 5000, 5000,
                            5000, 5000, 5000, 5000, 5000, 5000};
 uint32_t debounce_t0[]  = {0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0};
 uint8_t switch_counts[] = {0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0};
+uint8_t last_closure = 0xFF;    // Index of the most recent closure, 0xFF if none yet
+uint32_t last_closure_t = 0;    // millis() when it was confirmed
 uint8_t switch_states[] = {SW_READY, SW_READY, SW_READY, SW_READY, SW_READY, SW_READY,
                            SW_READY, SW_READY, SW_READY, SW_READY, SW_READY, SW_READY,
                            SW_READY, SW_READY, SW_READY, SW_READY};
@@ -121,6 +133,8 @@ int cmd_bytes_len = 0;
 uint16_t cmd_count = 0;
 uint16_t err_count = 0;
 uint8_t echo_reg = 0;
+uint16_t cfg_hash = 0;   // Hash of the config the pi last sent us.  Zero after power up.
+bool stamps_on = false;  // If replies end with the latest closure and its age.  Only if the pi asks.
 
 // Timmer Fucntions...
 uint32_t t0_timmer;
@@ -174,6 +188,27 @@ bool process_command() {
                 echo_reg = cmd_bytes[1];
             }
             return true;
+        case CMD_GET_RATES: {
+                echo_reg = bus.rate_mask();
+            }
+            return true;
+        case CMD_SET_RATE: {
+                bus.set_rate(cmd_bytes[1]);
+            }
+            return true;
+        case CMD_GET_CFG_HASH: {
+                if (cmd_bytes[1] == 0) echo_reg = cfg_hash & 0x00FF;
+                else echo_reg = (cfg_hash >> 8) & 0x00FF;
+            }
+            return true;
+        case CMD_SET_CFG_HASH: {
+                cfg_hash = ((uint16_t) cmd_bytes[2] << 8) | cmd_bytes[1];
+            }
+            return true;
+        case CMD_STAMPS: {
+                stamps_on = cmd_bytes[1] != 0;
+            }
+            return true;
         case CMD_DEBOUNCE: {
                 uint32_t tunit_on = cmd_bytes[1];
                 uint32_t tunit_off = cmd_bytes[2];   
@@ -188,8 +223,8 @@ bool process_command() {
         case CMD_DB_BANK: {
                 uint8_t ibank = cmd_bytes[1];
                 uint8_t mask  = cmd_bytes[2];
-                uint32_t tunit_on = cmd_bytes[1];
-                uint32_t tunit_off = cmd_bytes[2];   
+                uint32_t tunit_on = cmd_bytes[3];
+                uint32_t tunit_off = cmd_bytes[4];   
                 tunit_on *= 1000;
                 tunit_off *= 1000;
                 if(ibank >= 2) return true;
@@ -230,7 +265,18 @@ void load_response() {
         b |= (switch_counts[i * 2]) & 0x000F;
         response[5 + i] = b;
     }
-    bus.set_response(response, 13);
+    // If the Pi asked for them, the most recent closure, and how many ms ago
+    // it was (up to 255), so the Pi can tell when it happened.  The age changes
+    // every ms, so it is left out when the bus decides if a delta poll has
+    // anything new.
+    if (stamps_on) {
+        uint32_t age = millis() - last_closure_t;
+        response[13] = last_closure;
+        response[14] = age > 255 ? 255 : age;
+        bus.set_response(response, 15, 1);
+    } else {
+        bus.set_response(response, 13);
+    }
 }
 
 // --------------------------------------------------------------------
@@ -281,6 +327,8 @@ void get_inputs() {
                         switch_states[i] = SW_ACTIVE;
                         x = x | ibit;
                         switch_counts[i]++;
+                        last_closure = i;
+                        last_closure_t = millis();
                     }
                 }
                 break;
@@ -5,15 +5,18 @@
 #include "comm_bus.h"
 
 #define PIN_LED 13               // Led to flash on msg received/sent
-#define BAUD_RATE 115200         // Baud rate of the transmitter
-#define BYTE_USEC 87             // Number of usecs per byte at BAUD_RATE
 #define TX_TIME_PAD 80           // Number of usecs to pad TX enable
 
+// Baud rate for each rate code.  Code 0 is the rate every node starts at.
+static const unsigned long bus_rates[NRATES] = {115200, 250000, 500000, 1000000};
+
 // Constructs the CommBus object. Provide the node address and the
-// callback to be called when a message is received.
-CommBus::CommBus(int node_address, void (*on_receive)(uint8_t *msg, int n)) {
+// callback to be called when a message is received.  The rate mask
+// is what the host is told we can run at.
+CommBus::CommBus(int node_address, void (*on_receive)(uint8_t *msg, int n), uint8_t rate_mask) {
   _our_node_address = node_address;
   _on_receive = on_receive;
+  _rate_mask = rate_mask | RATE_MASK_BASE;
   // blink_led(3);
 }
 
@@ -23,11 +26,15 @@ CommBus::CommBus(int node_address, void (*on_receive)(uint8_t *msg, int n)) {
 // but there is no guarantee that any specific data
 // is sent back to the host.  That is, the caller may change
 // the data multiple times before the host makes a request to see it.
-void CommBus::set_response(uint8_t *data, int n) {
+// The last nskip bytes are left out when deciding if a delta poll
+// gets the short reply.  Use it for bytes that change all the time
+// but mean nothing new on their own, like the age of a closure.
+void CommBus::set_response(uint8_t *data, int n, int nskip) {
   for (int i = 0; i < n; i++) {
     _response_data[i] = data[i];
   }
   _response_data_len = n;
+  _response_skip = nskip;
   _new_response_pending = true;
 }
 
@@ -38,10 +45,46 @@ void CommBus::begin() {
   pinMode(PIN_LED, OUTPUT);
   digitalWrite(PIN_LED, LOW);
   _ledstate = 0;
-  Serial.begin(BAUD_RATE);
+  start_serial(0);
   prepare_outmsg();
 }
 
+// Returns the rates we can run at, as a rate mask.  For GET_RATES.
+uint8_t CommBus::rate_mask() {
+  return _rate_mask;
+}
+
+// Moves to the rate with the given code, once the reply being sent
+// (if any) is out, so the host hears it at the old rate.  For SET_RATE.
+// Codes for rates we can't do are ignored.
+void CommBus::set_rate(uint8_t code) {
+  if (code >= NRATES || (_rate_mask & (1 << code)) == 0) return;
+  _next_rate_code = code;
+}
+
+// Opens the serial port at the rate with the given code.
+void CommBus::start_serial(int code) {
+  if (code != _rate_code) Serial.end();
+  _rate_code = code;
+  Serial.begin(bus_rates[code]);
+  _byte_usec = (10000000UL + bus_rates[code] - 1) / bus_rates[code];
+  _last_good_ms = millis();
+  _comm_state = COMM_DIRTY;
+}
+
+// Switches rates when the time comes: when asked to, once the reply is out,
+// and back to the base rate when the bus has gone quiet for too long at a 
+// faster one, which is how the host gets us back if the rate doesn't work.
+void CommBus::manage_rate() {
+  if (_tx_pending || _tx_waiting) return;
+  if (_next_rate_code >= 0) {
+    start_serial(_next_rate_code);
+    _next_rate_code = -1;
+    return;
+  }
+  if (_rate_code != 0 && millis() - _last_good_ms > REVERT_MSEC) start_serial(0);
+}
+
 // Returns a flag, that if true, means that the update rountine needs to be
 // called very fast, at least once every 200 usec.  If not busy, then the
 // update routine can be called less frequently, say at leash once every 2 msec.
@@ -58,6 +101,7 @@ void CommBus::prepare_outmsg() {
   }
   _output_data[_response_data_len + 2] = checksum(_output_data, _response_data_len + 2);
   _output_data_len = _response_data_len + 3;
+  _output_skip = _response_skip;
   _new_response_pending = false;
 }
 
@@ -70,20 +114,44 @@ void CommBus::update() {
     _tx_waiting = false;
     _is_busy = false;
   }
+  manage_rate();
   if (_tx_pending) {
     _is_busy = true;
     flash_led();
     if (_new_response_pending) prepare_outmsg();
     if (micros() - _tx_t0 < 750) return;  // Must wait at least 0.5ms to start response.
+    uint8_t *out = _output_data;
+    int nout = _output_data_len;
+    int ncmp = nout - 6 - _output_skip;
+    if (ncmp < 0) ncmp = 0;
+    if (_delta_req && nout == _last_full_len && memcmp(_output_data + 5, _last_full + 5, ncmp) == 0) {
+      // Nothing new past the counts since the last full reply.  Send just the counts.
+      _short_data[0] = 'e';
+      _short_data[1] = ((_our_node_address & 0x000F) << 4) | 3;
+      for(int i = 2; i < 5; i++) _short_data[i] = _output_data[i];
+      _short_data[5] = checksum(_short_data, 5);
+      out = _short_data;
+      nout = 6;
+    } else {
+      for(int i = 0; i < nout; i++) _last_full[i] = _output_data[i];
+      _last_full_len = nout;
+    }
+    if (_seq_req && out == _output_data && nout > 5) {
+      // Acknowledge with the last seq taken, in place of the echo register.
+      // The reply is rebuilt for next time, to put the echo register back.
+      _output_data[4] = _last_seq;
+      _output_data[nout - 1] = checksum(_output_data, nout - 1);
+      _new_response_pending = true;
+    }
     digitalWrite(PIN_TX_ENABLE, HIGH);
     _tx_wait_t0 = micros();
-    for(int i = 0; i < _output_data_len; i++) Serial.write(_output_data[i]);
+    for(int i = 0; i < nout; i++) Serial.write(out[i]);
     // Kludge... Here we should be able to do a Serial.flush(), but 
     // that takes too long (over 2.5ms).  Instead, we calculate how
     // long to keep the transmitter enabled, and then shut it down 
     _tx_pending = false;
     _tx_waiting = true;
-    _tx_wtime = (BYTE_USEC * _output_data_len) + TX_TIME_PAD;
+    _tx_wtime = (_byte_usec * nout) + TX_TIME_PAD;
     return;
   }
 
@@ -95,6 +163,20 @@ void CommBus::update() {
       // The message is for us!
       _tx_pending = true;
       _tx_t0 = micros();
+      _delta_req = (_data_len == 1 && _rec_msg[2] == CMD_POLL_DELTA);
+      _seq_req = (_data_len >= 2 && _rec_msg[2] == CMD_SEQ);
+      if (!_seq_req) {
+        _on_receive(_rec_msg + 2, _data_len);
+      } else if (_rec_msg[3] == _last_seq) {
+        // A retry of a command we already took.  Count it as a poll.
+        _on_receive(_rec_msg + 2, 0);
+      } else {
+        _last_seq = _rec_msg[3];
+        _on_receive(_rec_msg + 4, _data_len - 2);
+      }
+    }
+    if (_rec_msg[0] == 'E' && _node_addr == BROADCAST_ADDRESS) {
+      // For everyone.  No response, or the nodes would all talk at once.
       _on_receive(_rec_msg + 2, _data_len);
     }
   }
@@ -209,6 +291,7 @@ void CommBus::read_serial_bus() {
       }
       _new_msg_waiting = true;
       _comm_state = COMM_READY;
+      _last_good_ms = millis();
       return;
     }
   }
@@ -9,6 +9,17 @@
 #include <Arduino.h>
 
 #define PIN_TX_ENABLE 2 // Pin to enable/disable RS-485 transmitter.
+#define BROADCAST_ADDRESS 15 // Messages to this address go to every node, and are not answered.
+#define CMD_POLL_DELTA 104   // Poll that gets a short reply if nothing changed since the last full one.
+#define CMD_SEQ 121          // Wrapper: seq, cmd...  The cmd is only run if seq differs from the last one.
+#define CMD_GET_RATES 102    // Sketches put rate_mask() in the echo register.
+#define CMD_SET_RATE 103     // Sketches pass the rate code to set_rate().
+
+// Bus rates, by rate code.  A rate mask has bit n set for rate code n.
+#define NRATES 4
+#define RATE_MASK_ALL  0x0F  // 115200, 250000, 500000 and 1000000
+#define RATE_MASK_BASE 0x01  // Just 115200, for nodes that can't keep up with more
+#define REVERT_MSEC 500      // Back to the base rate after this long without a good frame
 
 // Communication states...
 #define COMM_DIRTY     0 // The channel is dirty.  Waiting for reset
@@ -19,20 +30,35 @@
 
 class CommBus {
   public:
-    CommBus(int node_address, void (*on_receive)(uint8_t *msg, int n));
+    CommBus(int node_address, void (*on_receive)(uint8_t *msg, int n), uint8_t rate_mask = RATE_MASK_ALL);
     void begin();
     void update();
-    void set_response(uint8_t *msg, int n);
+    void set_response(uint8_t *msg, int n, int nskip = 0);
     bool is_busy(); 
+    uint8_t rate_mask();
+    void set_rate(uint8_t code);
 
   private:
     int _our_node_address;                     // The address of our node
     void (*_on_receive)(uint8_t *msg, int n);  // Callback on receive
     uint8_t _response_data[16];                // Pending response msg
     int _response_data_len = 0;                // Pending response msg len
+    int _response_skip = 0;                    // Trailing bytes of the pending response a delta poll ignores
     bool _new_response_pending = false;        // If the response data is new
     uint8_t _output_data[20];                  // The message being sent back to the host
     int _output_data_len = 3;                  // The number of bytes to transmit back to the host
+    int _output_skip = 0;                      // Trailing bytes of the output message a delta poll ignores
+    uint8_t _short_data[6];                    // Reply to a delta poll, when nothing changed
+    uint8_t _last_full[20];                    // The last full reply sent
+    int _last_full_len = 0;                    // Length of the last full reply
+    bool _delta_req = false;                   // If the message being answered is a delta poll
+    uint8_t _last_seq = 0;                     // Seq of the last SEQ wrapped command taken
+    bool _seq_req = false;                     // If the message being answered was SEQ wrapped
+    uint8_t _rate_mask = RATE_MASK_ALL;        // The rates we can run at
+    int _rate_code = 0;                        // The rate we are at
+    int _next_rate_code = -1;                  // Rate to switch to once the current reply is out
+    unsigned long _byte_usec = 87;             // Number of usecs per byte at the current rate
+    unsigned long _last_good_ms = 0;           // Time of the last good frame on the bus -- msecs
 
     int _comm_state = COMM_DIRTY;              // Current state of the communication channel
     uint8_t _rec_msg[20];                      // The input message.
@@ -55,6 +81,8 @@ class CommBus {
     int read_serial_byte();
     void read_serial_bus();
     void manage_serial_bus();
+    void start_serial(int code);
+    void manage_rate();
 
     // LED management
     unsigned long _ledtm = 0;
@@ -6,6 +6,7 @@
 
 import time
 from pb_log import log
+import flippers
 
 class BallManager():
 
@@ -46,9 +47,17 @@ class BallManager():
         log("Bit change detected.")
         self._last_bits = bits
         self._bit_change_pending = True
-        self._bit_change_pending_t0 = time.monotonic()
+        self._bit_change_pending_t0 = self._changed_at(flippers.TROUGH_SWITCHES)
         self._bits_stable = False
 
+    def _changed_at(self, mask):
+        # When the switches in the mask last changed, by the switch board.  The
+        # change may have been latched a while ago, by an update() that didn't
+        # come through here.
+        t = self._hw.switches().last_change_in(mask)
+        if t == 0.0: t = time.monotonic()
+        return t
+
     def count_balls_in_trough(self):
         ''' Returns a raw count of the number of balls in the
         trough -- no matter what their position. '''
@@ -111,11 +120,11 @@ class BallManager():
             if inhole == self._current_drop: return
             self._drop_change_pending = True 
             self._last_drop = inhole
-            self._last_drop_change_t0 = time.monotonic()
+            self._last_drop_change_t0 = self._changed_at(flippers.HOLE_SWITCH)
             return
         if inhole != self._last_drop:
             self._last_drop = inhole
-            self._last_drop_change_t0 = time.monotonic()
+            self._last_drop_change_t0 = self._changed_at(flippers.HOLE_SWITCH)
             return
         if time.monotonic() - self._last_drop_change_t0 < 1.5: return
         # Drop hole has been stable
@@ -32,9 +32,9 @@ class Bumpers():
 
     def queue_startup_cmds(self):
         cmd = [CMD_COILS_ENABLE, MASK_ALL_BUMPERS, 0]
-        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all bumpers coils")
+        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all bumpers coils", always=True)
         cmd = [CMD_LAMP_ENABLE, MASK_ALL_BUMPERS, 0]
-        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all bumper lamps")
+        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all bumper lamps", always=True)
 
         pwm= config.get_param('bumper_right', 'pwm', 150)
         t_on = config.get_param('bumper_right', 'on_time', 100)
@@ -91,12 +91,15 @@ class Bumpers():
             else: name = ""
             log(f"Sending Queued Command from Bumpers: {name}")
 
+    def disable_cmds(self):
+        '''Returns the commands that disable all the bumper coils and lamps.'''
+        return [[CMD_COILS_ENABLE, MASK_ALL_BUMPERS, 0], [CMD_LAMP_ENABLE, MASK_ALL_BUMPERS, 0]]
+
     def disable(self):
-        cmd = [CMD_COILS_ENABLE, MASK_ALL_BUMPERS, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        cmd_coils, cmd_lamps = self.disable_cmds()
+        self._hw.send_command(self._nodeadr, cmd_coils, hardware.PRI_SAFETY)
         log("Sending Command from Bumpers: Disabling all Bumper Coils")
-        cmd = [CMD_LAMP_ENABLE, MASK_ALL_BUMPERS, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd_lamps, hardware.PRI_SAFETY)
         log("Sending Command from Bumpers: Disabling all Bumper Lamps")
 
     def enable(self):
@@ -0,0 +1,140 @@
+# Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+# cmd_queue.py -- The queue of commands waiting to go to one node.
+#
+# Commands are queued at one of three levels, and a higher level always
+# goes first, so that a disable command never waits behind a backlog of
+# light changes.  Within a level, commands go in the order queued.
+#   SAFETY   -- Commands that make the machine safe (disabling coils, etc)
+#   GAMEPLAY -- Commands that play depends on (kickers, ball handling, etc)
+#   COSMETIC -- Lights and the like.  These are dropped if they get stale.
+#
+# A command must not pass an older one with the same opcode, or a disable
+# could be undone by an enable queued before it.  So, when a command is
+# queued, older ones with its opcode at lower levels are moved up with it.
+#
+# Entries are (id, cmd) tuples.  The caller does the locking.
+#
+
+import time
+import collections
+
+SAFETY = 0
+GAMEPLAY = 1
+COSMETIC = 2
+
+level_names = ("safety", "gameplay", "cosmetic")
+
+class CommandQueue():
+    ''' A queue with a deque for each priority level.  Cosmetic commands older
+    than stale_time secs are dropped by drop_stale().'''
+    def __init__(self, stale_time=0.5):
+        self._levels = [collections.deque() for _ in level_names]
+        self._level_of = {}      # id -> (level, time queued)
+        self._stale_time = stale_time
+        self._peaks = [0 for _ in level_names]
+        self._stale_drops = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self._levels)
+
+    def push(self, id, cmd, level=GAMEPLAY):
+        '''Adds a command at the back of its level.'''
+        q = self._levels[level]
+        if len(cmd) > 0: self._promote(cmd[0], level)
+        q.append((id, cmd))
+        self._level_of[id] = (level, time.monotonic())
+        if len(q) > self._peaks[level]: self._peaks[level] = len(q)
+
+    def _promote(self, op, level):
+        # Moves commands with the given opcode from lower levels to the back
+        # of this one, oldest first.
+        moved = []
+        for lower in range(level + 1, len(self._levels)):
+            q = self._levels[lower]
+            keep = [item for item in q if len(item[1]) == 0 or item[1][0] != op]
+            if len(keep) == len(q): continue
+            moved.extend(item for item in q if len(item[1]) > 0 and item[1][0] == op)
+            q.clear()
+            q.extend(keep)
+        moved.sort(key=lambda item: self._level_of[item[0]][1])
+        for item in moved:
+            self._levels[level].append(item)
+            self._level_of[item[0]] = (level, self._level_of[item[0]][1])
+
+    def push_front(self, item):
+        '''Puts a command that was taken back at the front of its level.  Its
+        level and age are as they were when it was first pushed.'''
+        level, _ = self._level_of.get(item[0], (GAMEPLAY, time.monotonic()))
+        self._levels[level].appendleft(item)
+        self._level_of.setdefault(item[0], (level, time.monotonic()))
+
+    def peek(self, n):
+        '''Returns up to n commands, in the order they would be taken.'''
+        items = []
+        for q in self._levels:
+            for item in q:
+                if len(items) >= n: return items
+                items.append(item)
+        return items
+
+    def take(self, n):
+        '''Removes and returns up to n commands, in order.  The ids are kept, so
+        that push_front() can put them back where they were.'''
+        items = []
+        for q in self._levels:
+            while len(q) > 0 and len(items) < n: items.append(q.popleft())
+        return items
+
+    def done(self, items):
+        '''Forgets commands that were taken and won't be put back.'''
+        for id, _ in items: self._level_of.pop(id, None)
+
+    def remove(self, id):
+        '''Removes a queued command.  Returns true if it was found.'''
+        if id not in self._level_of: return False
+        level, _ = self._level_of[id]
+        q = self._levels[level]
+        for i, item in enumerate(q):
+            if item[0] == id:
+                del q[i]
+                del self._level_of[id]
+                return True
+        return False
+
+    def drop_stale(self, tnow):
+        '''Removes cosmetic commands that have waited longer than the stale time.
+        Returns their ids.'''
+        q = self._levels[COSMETIC]
+        ids = []
+        while len(q) > 0:
+            id = q[0][0]
+            _, t = self._level_of[id]
+            if tnow - t <= self._stale_time: break
+            q.popleft()
+            del self._level_of[id]
+            ids.append(id)
+        self._stale_drops += len(ids)
+        return ids
+
+    def clear(self):
+        '''Empties the queue.  Returns the ids of everything that was in it.'''
+        ids = []
+        for q in self._levels:
+            ids.extend(id for id, _ in q)
+            q.clear()
+        self._level_of = {}
+        return ids
+
+    def depths(self):
+        '''Returns the number of commands waiting at each level.'''
+        return [len(q) for q in self._levels]
+
+    def report(self):
+        '''Returns a map of the depth and peak depth of each level, and the stale
+        drops so far.'''
+        rp = {}
+        for i, name in enumerate(level_names):
+            rp[name] = {"depth": len(self._levels[i]), "peak": self._peaks[i]}
+        rp["stale_drops"] = self._stale_drops
+        return rp
@@ -0,0 +1,122 @@
+# Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+# cmd_tracker.py -- Keeps track of what happened to each command sent
+# to a node: still pending, sent (done), or dropped.
+#
+# Status lookups are a dict access.  Finished commands are remembered in
+# a ring of fixed size, so if nobody ever asks about them, the oldest are
+# forgotten instead of piling up.  Pending commands are never forgotten.
+#
+# A caller can also ask for a callback, or a Future, for a command.  They
+# fire when the command finishes, with True if it was sent and False if it
+# was dropped.  Commands finish on whatever thread polls the nodes, often
+# while the command lock is held, so the firing is put off until notify()
+# is called with no locks held.
+#
+
+import threading
+import collections
+import concurrent.futures
+from pb_log import log
+
+PENDING = 0
+DONE = 1
+DROPPED = 2
+
+class CommandTracker():
+    def __init__(self, size=1000):
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._status = {}                              # id -> status
+        self._finished = collections.deque()           # Finished ids, oldest first
+        self._size = size
+        self._watchers = {}                            # id -> list of callbacks
+        self._ready = []                               # (callback, sent) waiting for notify()
+        self._npending = 0
+
+    def new_id(self):
+        '''Returns the id for a new, pending, command.'''
+        self._lock.acquire()
+        self._last_id += 1
+        id = self._last_id
+        self._status[id] = PENDING
+        self._npending += 1
+        self._lock.release()
+        return id
+
+    def completed(self, id):
+        '''Marks a command as sent.'''
+        self._finish(id, DONE)
+
+    def dropped(self, id):
+        '''Marks a command as dropped.'''
+        self._finish(id, DROPPED)
+
+    def _finish(self, id, status):
+        self._lock.acquire()
+        if self._status.get(id) == PENDING:
+            self._status[id] = status
+            self._npending -= 1
+            self._finished.append(id)
+            if len(self._finished) > self._size:
+                self._status.pop(self._finished.popleft(), None)
+            for cb in self._watchers.pop(id, []): self._ready.append((cb, status == DONE))
+        self._lock.release()
+
+    def status(self, id):
+        '''Returns PENDING, DONE or DROPPED -- or None if the id is unknown, or
+        finished so long ago it was forgotten.'''
+        self._lock.acquire()
+        st = self._status.get(id)
+        self._lock.release()
+        return st
+
+    def take(self, id, status):
+        '''Returns true if the command has the given status, and if so, forgets it.
+        This is how command_done() and command_dropped() work.'''
+        self._lock.acquire()
+        found = self._status.get(id) == status
+        if found: del self._status[id]
+        self._lock.release()
+        return found
+
+    def watch(self, id, callback):
+        '''Has callback(sent) called once the command finishes.  If it already has,
+        the call happens at the next notify().'''
+        self._lock.acquire()
+        st = self._status.get(id)
+        if st == PENDING: self._watchers.setdefault(id, []).append(callback)
+        elif st is not None: self._ready.append((callback, st == DONE))
+        self._lock.release()
+
+    def future(self, id):
+        '''Returns a concurrent.futures.Future, that gets the result True when the
+        command is sent, or False if it is dropped.  If the command has already
+        finished, the Future is done at once.  If the id is unknown, or was
+        forgotten, nothing would ever finish it, so it is done at once with a
+        KeyError.'''
+        fut = concurrent.futures.Future()
+        fut.set_running_or_notify_cancel()
+        self._lock.acquire()
+        st = self._status.get(id)
+        if st == PENDING: self._watchers.setdefault(id, []).append(fut.set_result)
+        self._lock.release()
+        if st is None: fut.set_exception(KeyError(f"Unknown or forgotten command id {id}"))
+        elif st != PENDING: fut.set_result(st == DONE)
+        return fut
+
+    def notify(self):
+        '''Fires the callbacks for commands that have finished.  Call with no locks held.'''
+        if len(self._ready) == 0: return
+        self._lock.acquire()
+        ready = self._ready
+        self._ready = []
+        self._lock.release()
+        for cb, sent in ready: 
+            try:
+                cb(sent)
+            except Exception as err:
+                log(f"Error in command callback {type(err)}: {str(err)}")
+
+    def pending_count(self):
+        return self._npending
@@ -8,6 +8,57 @@ from pb_log import log
 
 config = {
     "active_nodes": [2, 3, 4, 5, 6, 7, 8],
+    "comm_bus": {
+        "tx_mode": "sleep",     # How the end of a transmit is found: "sleep", "drain" or "rs485" (try others once measured on the machine)
+        "rx_mode": "spin",      # How we wait for replies: "spin" or "select" (try select once measured on the machine)
+        "tuning": False,        # Lock the port and set it for low latency (turn on if bin/bus_calibrate says it helps)
+        "adaptive_gap": False,  # Learn the quiet time nodes need between messages (try once measured on the machine)
+        "gap_min": 0.001,       # Shortest quiet time on the bus before a message (secs)
+        "gap_max": 0.010,       # Quiet time for unknown nodes, and after errors (secs)
+        # Least gap for nodes that can miss frames while busy, like the light nodes (secs).
+        # Every node on a segment hears every frame, so the segment's gap is the most any
+        # of its nodes needs.  With the light nodes on the main segment, that's always
+        # 10 ms, and adaptive_gap gains nothing until they are on a segment of their own.
+        "gap_floors": {2: 0.010, 3: 0.010},
+        "stats_window": 500,    # Number of recent cycles the per-node timing stats cover
+        "baud_rates": [115200], # Rates a segment may move up to at startup (faster needs node firmware support)
+        "fallback_errs": 10,    # Bad cycles, out of the last fallback_window, that send a
+        "fallback_window": 200, #   faster segment back to 115200
+        # Each bus segment is a serial port and the nodes wired to it.  Segments
+        # are polled at the same time, on their own threads when io_thread is on.
+        "segments": {
+            "main": {"port": "/dev/ttyAMA0", "tx_enable_pin": 12, "nodes": [2, 3, 4, 5, 6, 7, 8]}
+        }
+    },
+    "hardware": {
+        "io_thread": False,     # Poll the nodes on a background thread, instead of in the game loop
+        "scheduler": "round_robin",  # How nodes are picked for polling: "round_robin" or "weighted".
+                                 # Stay on round_robin until the poll_rates below are measured on the machine.
+        # Target polls per second, by node.  With the fixed 10 ms gap, a segment does
+        # about 90 cycles/s in all, and inline (io_thread off) those come out of the
+        # game loop, so these add up to less than that.  Raise them along with
+        # io_thread, a learned gap, or more segments.
+        "poll_rates": {4: 25, 5: 8, 6: 8, 7: 18, 8: 18},
+        "poll_priorities": {4: 0, 7: 1, 8: 1, 5: 2, 6: 2},     # Lower is polled first in a pass
+        "activity_boost": 2.0,  # Rate multiplier for a node that just had switch activity
+        "boost_time": 2.0,      # How long the boost lasts (secs)
+        "max_visits": 4,        # Most visits to one node in a pass, when passes come slower than its rate
+        "packed_cmd_nodes": [], # Nodes that accept several commands per frame.  Keep empty: no node firmware has PACKED yet
+        "neo_group_nodes": [],  # Light nodes that accept NEO_GROUP commands.  Keep empty: no light node firmware has it yet
+        "coalesce_nodes": [2, 3], # Light nodes where a newer pixel or lamp command replaces an unsent older one
+        "broadcast_safe_state": False, # Disable coils with one broadcast frame (needs node firmware support)
+        "delta_poll_nodes": [],  # Input nodes polled with POLL_DELTA (needs the new comm_bus library on the node)
+        "timestamp_nodes": [],  # Input nodes told at startup to end their replies with their latest closure and its age (needs new node firmware)
+        "seq_nodes": [],        # Nodes sent commands with sequence numbers, so retries are never run twice (needs the new comm_bus library)
+        "seq_retries": 3,       # Immediate retries of a sequenced command before trying again on the next update
+        "cosmetic_stale_time": 1.0, # Cosmetic commands (lights) waiting longer than this are dropped (secs)
+        "startup_deadline": 3.0,     # Longest conduct_startup() may take, for all nodes together (secs)
+        "startup_node_timeout": 1.0, # A node quiet this long during startup is failed (secs)
+        "startup_backoff": 0.005,    # First wait before retrying a startup command (secs), doubled each retry
+        "startup_backoff_max": 0.2,  # Longest wait between startup retries (secs)
+        "cfg_hash_nodes": [],   # Nodes that keep a hash of their startup config, so it isn't resent if unchanged (needs new node firmware)
+        "tracked_cmds": 1000    # Finished commands remembered for command_done() and command_dropped()
+    },
     "flipper_right": {
         "name": "right flipper",
         "pwm1": 255,
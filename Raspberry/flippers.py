@@ -7,6 +7,8 @@ from pb_log import log
 import hardware 
 import event_manager
 import config 
+import switch_board
+from hw_events import Ev
 
 CMD_FLIPPER_PWM    =  10
 CMD_FLIPPER_CTRL   =  11
@@ -35,6 +37,12 @@ MASK_HOLE_SWITCH      = 0b10000000
 
 BALL_1_BIT_POS        = 3
 
+# The same switches, on the machine's switch board
+SW_BALL_1_READY = Ev.F4
+SW_HOLE         = Ev.F8
+TROUGH_SWITCHES = switch_board.mask_for((Ev.F4, Ev.F5, Ev.F6, Ev.F7))
+HOLE_SWITCH     = switch_board.bit(SW_HOLE)
+
 class Flippers():
     ''' Takes care of stuff with the flipper's node, including
     game start, and ball cycling.'''
@@ -47,7 +55,7 @@ class Flippers():
 
     def queue_startup_cmds(self):
         cmd = [CMD_FLIPPER_ENABLE, MASK_ALL_FLIPPERS, 0]
-        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all flippers")
+        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all flippers", always=True)
 
         pwm1 = config.get_param('flipper_right', 'pwm1', 255)
         pwm2 = config.get_param('flipper_right', 'pwm2', 255)
@@ -77,7 +85,7 @@ class Flippers():
  
     def new_ball(self):
         '''Puts a new ball into the game.'''
-        bits = self._hw.get_switch_state(self._nodeadr)
+        bits = self._hw.switches().node_bits('F')
         sbits = ""
         for i in range(8):
             if 1 << (7 - i) & bits != 0: sbits += "X"
@@ -122,9 +130,13 @@ class Flippers():
             else: name = ""
             log(f"Sending Queued Command from Flippers: {name}")
 
+    def disable_cmds(self):
+        '''Returns the commands that disable all the flippers.'''
+        return [[CMD_FLIPPER_ENABLE, MASK_ALL_FLIPPERS, 0]]
+
     def disable_flippers(self):
-        cmd = [CMD_FLIPPER_ENABLE, MASK_ALL_FLIPPERS, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        cmd = self.disable_cmds()[0]
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_SAFETY)
         log("Sending Command from Flippers: Disable All Flippers.")
 
     def enable_main_flippers(self):
@@ -139,38 +151,26 @@ class Flippers():
 
     def disable_thrid_flipper(self):
         cmd = [CMD_FLIPPER_ENABLE, MASK_FLIPPER_THIRD, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_SAFETY)
         log("Sending Command from Flippers: Disable Third Flipper.")
 
     def balls_in_trough(self):
         '''Returns the number of balls in the trough.'''
-        bits = self._hw.get_switch_state(self._nodeadr) 
-        nballs = 0
-        if bits & MASK_BALL_1_READY != 0: nballs += 1    # Ball next to release gate
-        if bits & MASK_BALL_2_READY != 0: nballs += 1    # Next Ball
-        if bits & MASK_BALL_3_READY != 0: nballs += 1    # Next Ball
-        if bits & MASK_BALL_4_READY != 0: nballs += 1    # Ball under drain hole
-        return nballs
+        return self._hw.switches().count(TROUGH_SWITCHES)
 
     def ball_ready_to_cycle(self):
         '''Returns true if a ball is ready to cycle.  This means
         that there are two balls against the gate.'''
-        bits = self._hw.get_switch_state(self._nodeadr) 
-        if bits & MASK_BALL_1_READY != 0 and bits & MASK_BALL_2_READY != 0: return True
-        return False
+        return self._hw.switches().bits(SW_BALL_1_READY, 2) == 0b11
 
     def get_ball_bits(self):
         ''' Returns the four ball bits (shifted to the LSB) that represent
         the position of balls in the trough. '''
-        bits = self._hw.get_switch_state(self._nodeadr)
-        ball_bits = (bits >> BALL_1_BIT_POS) & 0x0F
-        return ball_bits
+        return self._hw.switches().bits(SW_BALL_1_READY, 4)
 
     def ball_in_hole(self):
         ''' Returns true if a ball is in the hole.'''
-        bits = self._hw.get_switch_state(self._nodeadr) 
-        if bits & MASK_HOLE_SWITCH != 0: return True
-        return False 
+        return self._hw.switches().closed(SW_HOLE)
 
     def eject_drop_ball(self):
         # Assume that the pwm is properly set up.
@@ -29,6 +29,8 @@ import logic_lanes
 import logic_targets
 import logic_panic
 import neo_colors as cc
+import hw_events
+from hw_events import Ev
 
 
 class PinballMachine():
@@ -50,6 +52,11 @@ class PinballMachine():
         self._lane_logic = logic_lanes.LogicLanes(self, self._hw, self._sound, self._plights)
         self._target_logic = logic_targets.LogicTargets(self, self._hw, self._sound, self._plights)
         self._panic_logic = logic_panic.LogicPanic(self, self._hw, self._sound, self._plights)
+        self._hw_dispatch = hw_events.EventDispatcher()
+        self._hw_dispatch.register(self._lane_logic.hw_handlers())
+        self._hw_dispatch.register(self._target_logic.hw_handlers())
+        self._hw_dispatch.register(self._panic_logic.hw_handlers())
+        self._hw_dispatch.register(self.hw_handlers())
         self._game_events = event_manager.EventManager()
         self._highscore = highscore.get_highscore()
         self._nballs = 0   # Number of balls remaining in game, including ball in play.
@@ -167,18 +174,17 @@ class PinballMachine():
         self._lanes.queue_startup_cmds()
         self._targets.queue_startup_cmds()
         t0 = time.monotonic()
-        errmsg = self._hw.conduct_startup()
+        errmsg = self._hw.conduct_startup(self.show_startup_progress)
         if errmsg is not None:
             self._machine_broken = True 
             self._errmsg = errmsg
         else:
             self._errmsg = "" 
             self._machine_broken = False
+            self._hw.start_io_thread()
             self._flippers.eject_drop_ball() 
             self._flippers.lift_motor_cycle(4.0)
-            self._flippers.disable_flippers() 
-            self._bumpers.disable()
-            self._kickers.disable()
+            self.disable_coils()
             for i in range(5): 
                 self._hw.update()
                 time.sleep(0.1) 
@@ -196,6 +202,32 @@ class PinballMachine():
         tperiod = config.get_game_param("check_highscore_period", 10)
         self.add_repeating_game_event("Check Highscore", tperiod)
 
+    def show_startup_progress(self, progress):
+        '''Shows how far the hardware startup has got.  Progress is a list of
+        (node name, commands sent, commands total, state).'''
+        nsent = sum(p[1] for p in progress)
+        ntotal = sum(p[2] for p in progress)
+        waiting = " ".join(p[0] for p in progress if p[3] in ("sending", "retrying"))
+        failed = " ".join(p[0] for p in progress if p[3] == "failed")
+        if failed != "": waiting = "Failed: " + failed
+        self.show_score("<Initializing>", "Configuring Hardware", f"{nsent}/{ntotal} Commands", waiting)
+
+    def disable_coils(self):
+        '''Disables the flippers, bumpers and kickers.  If the nodes support it, 
+        this is done with one broadcast frame, with the usual commands as a
+        fallback for any node that misses it.'''
+        if not config.get_param("hardware", "broadcast_safe_state", False):
+            self._flippers.disable_flippers() 
+            self._bumpers.disable()
+            self._kickers.disable()
+            return
+        fallback = {}
+        fallback[hardware.NODE_FLIPPERS] = self._flippers.disable_cmds()
+        fallback[hardware.NODE_BUMPERS] = self._bumpers.disable_cmds()
+        fallback[hardware.NODE_KICKERS] = self._kickers.disable_cmds()
+        self._hw.broadcast_command([hardware.CMD_SAFE_STATE], fallback)
+        log("Broadcasting Safe State: Disabling Flippers, Bumpers and Kickers")
+
     def show_warning(self, txt):
         self._errmsg = txt 
         self._game_events.remove_name("Clear Warning")
@@ -246,9 +278,7 @@ class PinballMachine():
         self._slights.on_game_over()
         self._plights.on_game_over()
         self._flippers.eject_drop_ball()
-        self._flippers.disable_flippers()
-        self._bumpers.disable()
-        self._kickers.disable()
+        self.disable_coils()
         self._panic_logic.on_game_over()
         self._prevent_new_game = True 
         self._prevent_game_t0 = time.monotonic()
@@ -324,38 +354,49 @@ class PinballMachine():
         events = self._hw.get_events()
         for e in events:
             log(f"Event: {e}")
-            self._lane_logic.process_hw_event(e)
-            self._target_logic.process_hw_event(e)
-            self._panic_logic.process_hw_event(e)
-            if e == "F1": # Right Flipper Button
-                self.add_to_score(1) 
-            if e == "F2": # Left Flipper Button
-                self.add_to_score(1)
-            if e == "F3": # Start Button
-                if self._game_active: 
-                    # Shortcut to spinning the lift motor some more.
-                    self._flippers.lift_motor_cycle(1.5)
-                    log("Start button pressed on Game Active. Spining lift motor.")
-                    continue
-                if self._prevent_new_game: 
-                    log("Rejecting new game request.")
-                    continue 
-                self.start_new_game()
-                return 
-            if e in ["L5"]:
-                self._flippers.enable_thrid_flipper()
-            if e in ["K1", "K2", "K3"]:
-                if self._game_active:
-                    points = config.get_points("kicker_hit", 25)
-                    self.add_to_score(points) 
-                    self.sound(sm.S_DING_KICKER)
-                    log(f"Kicker Hit. ({e}). Awarded {points} points.")
-            if e in ["B1", "B2", "B3"]:
-                if self._game_active:
-                    points = config.get_points("bumper_hit", 50)
-                    self.add_to_score(points) 
-                    self.sound(sm.S_DING_JET_BUMPERS)
-                    log(f"Bumper Hit. ({e}). Awarded {points} points.")
+            if self._hw_dispatch.dispatch(e): return
+
+    def hw_handlers(self):
+        ''' Returns the dispatch table for the hardware events handled here.  The 
+        lane, target and panic logic have their own.'''
+        return {(Ev.F1, Ev.F2): self.on_flipper_button,
+                Ev.F3: self.on_start_button,
+                Ev.L5: self.on_side_lane,
+                (Ev.K1, Ev.K2, Ev.K3): self.on_kicker_hit,
+                (Ev.B1, Ev.B2, Ev.B3): self.on_bumper_hit}
+
+    def on_flipper_button(self, ev):
+        self.add_to_score(1) 
+
+    def on_start_button(self, ev):
+        # Returns True if a new game was started, so the rest of the events are skipped.
+        if self._game_active: 
+            # Shortcut to spinning the lift motor some more.
+            self._flippers.lift_motor_cycle(1.5)
+            log("Start button pressed on Game Active. Spining lift motor.")
+            return False
+        if self._prevent_new_game: 
+            log("Rejecting new game request.")
+            return False
+        self.start_new_game()
+        return True
+
+    def on_side_lane(self, ev):
+        self._flippers.enable_thrid_flipper()
+
+    def on_kicker_hit(self, ev):
+        if self._game_active:
+            points = config.get_points("kicker_hit", 25)
+            self.add_to_score(points) 
+            self.sound(sm.S_DING_KICKER)
+            log(f"Kicker Hit. ({ev}). Awarded {points} points.")
+
+    def on_bumper_hit(self, ev):
+        if self._game_active:
+            points = config.get_points("bumper_hit", 50)
+            self.add_to_score(points) 
+            self.sound(sm.S_DING_JET_BUMPERS)
+            log(f"Bumper Hit. ({ev}). Awarded {points} points.")
                     
     def show_score(self, gp=None, g1=None, g2=None, g3=None):
         self._screen.score().main_score = self._score
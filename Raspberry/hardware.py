@@ -10,6 +10,13 @@
 #  B1 - B3  : Jet Bummpers
 #  K1 - K3  : Kickers  
 # 
+# Each event is a HwEvent: an integer event code from hw_events.py (compare 
+# it with Ev.T3, etc), which prints as its name, and also carries when the
+# switch closed.  Nodes listed in "timestamp_nodes" in the config are told at
+# startup to report how long ago their most recent closure was, so that one
+# gets an exact time.
+# Other closures are only known to be since the poll before.
+# 
 # States:
 # Switch states can also be returned.  These are simply bitmaps, where each
 # bit coresponds to a single switch.
@@ -21,12 +28,20 @@ import pygame as pyg
 import common 
 if common.platform() == "real":
     import comm_bus
-    comm = comm_bus.CommBus()
 else:
-    comm = None
+    comm_bus = None
 import pb_log
 from pb_log import log, logd 
 import config
+import poll_scheduler
+import cmd_queue
+import cmd_tracker
+import cmd_pack
+import bus_stats
+import hw_events
+import sw_counts
+import switch_board
+import cfg_plan
 
 NODE_BLIGHTS  = 2
 NODE_PLIGHTS  = 3
@@ -46,128 +61,445 @@ nodes = {NODE_BLIGHTS:  {'name': "S Lts",  "nsw":  0, "ibs": 0, "designator":'S'
          NODE_TARGETS:  {'name': "Targs",  "nsw":  8, "ibs": 2, "designator":'T'} }
     #    NODE_TEST:     {'name': "Test ",  "nsw":  0, "ibs": 1} }
 
-completed_cmds = []
-dropped_cmds = []
-last_cmd_id = 0
+# Understood by every node that has coils, and meant to be broadcast.  
+# Puts the node in the same state as the disable commands in flippers.py,
+# bumpers.py and kickers.py.  Needs the node firmware that knows about it.
+CMD_SAFE_STATE = 101
+
+# A poll that gets back only the three count bytes if the switch state and
+# counters haven't changed since the node's last full reply.  Handled in the
+# comm_bus library on the nodes.
+CMD_POLL_DELTA = 104
+
+# Turns the closure stamps at the end of an input node's replies on (arg 1)
+# or off (arg 0).  They are off when the node powers up.
+CMD_STAMPS = 107
+
+class HwEvent(int):
+    '''A hardware event.  Acts just like its event code (e.g. Ev.T3), prints as its
+    name, and also has:
+        t_closure -- When the switch closed (monotonic time)
+        t_poll    -- When the poll that found it went out 
+        exact     -- True if the node reported t_closure.  If not, t_closure is 
+                     the earliest it could have been: the poll before.'''
+    def __new__(cls, code, t_closure=None, t_poll=None, exact=False):
+        ev = int.__new__(cls, code)
+        tnow = time.monotonic()
+        ev.t_closure = tnow if t_closure is None else t_closure
+        ev.t_poll = tnow if t_poll is None else t_poll 
+        ev.exact = exact
+        return ev
+
+    def __str__(self):
+        return hw_events.names[self]
+
+    __repr__ = __str__
+
+# Priorities for send_command().  Higher ones go first.  Stale cosmetic
+# commands are dropped.  See cmd_queue.py.
+PRI_SAFETY   = cmd_queue.SAFETY
+PRI_GAMEPLAY = cmd_queue.GAMEPLAY
+PRI_COSMETIC = cmd_queue.COSMETIC
+
+
+# Light node commands that only set state.  An unsent one of these is 
+# obsolete once a newer one with the same key is queued.
+_LIGHT_NEO_SINGLE = 2
+_LIGHT_LAMP_CMDS = (8, 9, 10)   # LAMP_SOLID, LAMP_FLASH, LAMP_MODULATE
+
+def light_cmd_key(cmd):
+    '''Returns the coalescing key for a light node command: the opcode plus the
+    pixel index or lamp mask.  None is returned if the command can't be coalesced.'''
+    if len(cmd) == 0: return None
+    op = cmd[0]
+    if op == _LIGHT_NEO_SINGLE and len(cmd) >= 8: return (op, cmd[7])
+    if op in _LIGHT_LAMP_CMDS and len(cmd) >= 2: return (op, cmd[1])
+    return None
 
 class Node():
-    def __init__(self, node_addr):
+    def __init__(self, node_addr, cmd_lock, bus, tracker):
         self._node_addr = node_addr
+        self._cmd_lock = cmd_lock
+        self._bus = bus
+        self._tracker = tracker
         self._name = nodes[node_addr]['name']
         self._nsw = nodes[node_addr]['nsw']
         self._ibs = nodes[node_addr]['ibs']
         self._designator = nodes[node_addr]['designator']
+        self._ev_codes = [hw_events.event_code(self._designator, i) for i in range(self._nsw)]
         self._active = True 
         self._reported_cmd_cnt = 0 
         self._reported_err_cnt = 0 
         self._response_errs = 0
-        self._have_init_counts = False 
-        self._sw_counts = []
+        self._have_cmd_cnt = False 
+        self._bcast_fallback = None  # Commands to send if the last broadcast didn't arrive
+        self._bcast_cmd_cnt = 0      # Node's cmd count, as of just before the broadcast
+        self._nswb = sw_counts.count_bytes(self._nsw)
+        self._sw_count_bytes = None  # Counter bytes from the last reply.  None until we have one.
         self._sw_state = 0
         self._last_comm_attemp_time = 0
         self._last_comm_success_time = time.monotonic()
-        self._cmd_queue = [] 
-        for i in range(self._nsw): self._sw_counts.append(0)
-
-    def _split_bytes(self, dat):
-        idat = [] 
-        for x in dat:
-            idat.append(x & 0x000F) 
-            idat.append((x >> 4) & 0x000F)
-        return idat
+        self._cmd_queue = cmd_queue.CommandQueue(config.get_param("hardware", "cosmetic_stale_time", 0.5))
+        self._packing = node_addr in config.get_param("hardware", "packed_cmd_nodes", [])
+        self._neo_group = node_addr in config.get_param("hardware", "neo_group_nodes", [])
+        self._coalesce = node_addr in config.get_param("hardware", "coalesce_nodes", [])
+        self._delta = node_addr in config.get_param("hardware", "delta_poll_nodes", [])
+        self._delta_ok = False      # If our switch data matches the node's last full reply
+        self._stamps = node_addr in config.get_param("hardware", "timestamp_nodes", [])
+        self._last_poll_t = None    # When our last good poll went out
+        self._seq_on = node_addr in config.get_param("hardware", "seq_nodes", [])
+        self._seq_retries = config.get_param("hardware", "seq_retries", 3)
+        self._seq = 0               # Last sequence number used
+        self._seq_synced = False    # If the node has taken a seq from us since we started
+        self._inflight = None       # (frame, items, seq) sent, but not known to be taken
+        self._acked = False         # If the last reply acknowledged the seq we sent
+        self._pending_keys = {}     # Coalescing key -> id of the unsent command with that key
+        self._frames_saved = 0      # Commands dropped because a newer one replaced them
 
     def get_switch_state(self):
         return self._sw_state
 
-    def queue_command(self, dat): 
-        global last_cmd_id
-        last_cmd_id += 1
-        self._cmd_queue.insert(0, (last_cmd_id, dat))
-        return last_cmd_id
+    def designator(self):
+        return self._designator
+
+    def pack_startup(self, cmds):
+        '''Returns (payload, n): the next frame for a list of startup commands, and
+        how many of them it holds.  Packed if the node takes packed frames.'''
+        if not self._packing: return cmds[0], 1
+        return cmd_pack.pack(cmds, self._neo_group)
+
+    def last_poll_time(self):
+        return self._last_poll_t
+
+    def queue_command(self, dat, priority=PRI_GAMEPLAY): 
+        '''Queues a command for the node.  Caller must hold the command lock.'''
+        id = self._tracker.new_id()
+        if self._coalesce:
+            key = light_cmd_key(dat)
+            if key is not None:
+                old_id = self._pending_keys.get(key)
+                if old_id is not None: self._drop_queued(old_id)
+                self._pending_keys[key] = id
+        self._cmd_queue.push(id, dat, priority)
+        return id
+
+    def _drop_queued(self, id):
+        '''Removes a superseded command from the queue, and reports it as dropped.'''
+        if self._cmd_queue.remove(id):
+            self._tracker.dropped(id)
+            self._frames_saved += 1
+
+    def _forget_keys(self, items):
+        '''Called when commands leave the queue, so they can't be coalesced anymore.'''
+        if not self._coalesce: return
+        for id, dat in items:
+            key = light_cmd_key(dat)
+            if key is not None and self._pending_keys.get(key) == id: del self._pending_keys[key]
+
+    def frames_saved(self):
+        return self._frames_saved
 
-    def _attempt_comm(self, dat):
+    def queue_depth(self):
+        return len(self._cmd_queue)
+
+    def queue_report(self):
+        '''Returns the depths of the command queue by priority.  See CommandQueue.report().'''
+        return self._cmd_queue.report()
+
+    def _drop_stale(self):
+        # Cosmetic commands that waited too long aren't worth sending.
+        ids = self._cmd_queue.drop_stale(time.monotonic())
+        if len(ids) == 0: return
+        for id in ids: self._tracker.dropped(id)
+        if self._coalesce:
+            for key in [k for k, id in self._pending_keys.items() if id in ids]: del self._pending_keys[key]
+
+    def _take_commands(self):
+        '''Takes the next command off the queue -- or, if packing is on for this
+        node, as many commands as fit in one frame.  Returns the payload to send
+        and the queue entries it covers.  Caller must hold the command lock.'''
+        self._drop_stale()
+        if len(self._cmd_queue) == 0: return None, []
+        if not self._packing: 
+            items = self._cmd_queue.take(1)
+            self._forget_keys(items)
+            return items[0][1], items
+        items = self._cmd_queue.peek(8)
+        max_payload = cmd_pack.MAX_PAYLOAD
+        if self._seq_on: max_payload -= cmd_pack.SEQ_OVERHEAD
+        dat, n = cmd_pack.pack([cmd for _, cmd in items], self._neo_group, max_payload)
+        items = self._cmd_queue.take(n)
+        self._forget_keys(items)
+        return dat, items
+
+    def _seq_frame(self, dat):
+        '''Wraps a payload with the next sequence number, if that is on for this 
+        node.  Returns the frame payload and its seq (None if not wrapped).'''
+        if not self._seq_on or dat is None: return dat, None
+        seq = cmd_pack.next_seq(self._seq)
+        frame = cmd_pack.wrap_seq(seq, dat)
+        if frame is None: return dat, None    # Too long to wrap.  Sent as is.
+        self._seq = seq
+        return frame, seq
+
+    def _sync_frame(self):
+        '''Returns (payload, items, seq) for the frame that sets the node's last
+        seq to one we know.  Until that is acknowledged, a leftover seq from before
+        we started could match our first one, and its commands would be skipped.'''
+        seq = cmd_pack.next_seq(self._seq)
+        self._seq = seq
+        return cmd_pack.sync_seq(seq), [], seq
+
+    def resync(self):
+        '''Has the next sequenced frame sync the node's seq first.  Called when the
+        node may have restarted, and so lost the seq we gave it.'''
+        self._seq_synced = False
+
+    def _requeue(self, items):
+        '''Puts commands that failed to send back on the queue, in their original 
+        order -- unless a newer command with the same key has been queued since.
+        Caller must hold the command lock.'''
+        for item in reversed(items):
+            id, dat = item
+            if self._coalesce:
+                key = light_cmd_key(dat)
+                if key is not None:
+                    if key in self._pending_keys:
+                        self._tracker.dropped(id)
+                        self._frames_saved += 1
+                        self._cmd_queue.done([item])
+                        continue
+                    self._pending_keys[key] = id
+            self._cmd_queue.push_front(item)
+
+    def switch_count(self):
+        return self._nsw
+
+    def expect_broadcast(self, fallback):
+        '''Called just after a broadcast went out.  The next reply from the node
+        tells us if it got it.  If not, the fallback commands (a list) are queued
+        for it.  Caller must hold the command lock.'''
+        if not self._have_cmd_cnt or not self._active:
+            for cmd in fallback: self.queue_command(cmd, PRI_SAFETY)
+            return
+        self._bcast_fallback = fallback
+        self._bcast_cmd_cnt = self._reported_cmd_cnt
+
+    def _check_broadcast(self, cmd_cnt):
+        # The node counts every frame it takes, so the broadcast plus
+        # this cycle should have moved the count by two.
+        fallback = self._bcast_fallback
+        self._bcast_fallback = None
+        if cmd_cnt == (self._bcast_cmd_cnt + 2) & 0x00FF: return
+        log(f"Node {self._name} missed a broadcast.  Sending {len(fallback)} commands directly.")
+        self._cmd_lock.acquire()
+        for cmd in fallback: self.queue_command(cmd, PRI_SAFETY)
+        self._cmd_lock.release()
+
+    def _attempt_comm(self, dat, seq=None):
         events = []
         if not self._node_addr in config.get_active_nodes(): return events
         if dat is None and self._node_addr in [2, 3]: return events
-        rsp = comm.node_io(self._node_addr, dat) 
+        # A delta poll is only safe if we got the node's last reply.
+        delta = dat is None and self._delta and self._delta_ok
+        if delta: dat = [CMD_POLL_DELTA]
+        rsp = self._bus.node_io(self._node_addr, dat) 
         self._last_comm_attemp_time = time.monotonic()
+        t_prev = self._last_poll_t
         if rsp == None: 
+            self._delta_ok = False
             telp = time.monotonic() - self._last_comm_success_time
             if telp > 5.00 and not self._node_addr in [2, 3]:
                 if self._active: log(f"Node {self._name} going inactive.")
                 self._active = False
+                self.resync()
             return None
         self._last_comm_success_time = time.monotonic() 
+        t_poll = self._last_poll_t = self._bus.tx_start_time()
         if not self._active: log(f"Node {self._name} going active.") 
         self._active = True
+        # The reply to a sequenced frame has the node's last seq in place of the echo register.
+        self._acked = seq is not None and len(rsp) >= 3 and rsp[2] == seq
+        if len(rsp) > 0:
+            if self._bcast_fallback is not None: self._check_broadcast(rsp[0])
+            self._reported_cmd_cnt = rsp[0]
+            self._have_cmd_cnt = True
         if self._ibs == 0: return events
+        if delta and len(rsp) == 3: return events   # Nothing has changed.
         nb, ib0, ib1 = 1, 3, 4
         if self._ibs == 2: 
             nb, ib0, ib1 = 2, 3, 5
-        nswb = int(self._nsw / 2) 
-        if self._nsw % 2 != 0: nswb += 1  
+        nswb = self._nswb
         if len(rsp) < 3 + nb + nswb:
             self._response_errs += 1      
+            self._delta_ok = False
             return events
+        self._delta_ok = True
+        # The node's most recent closure comes in the last two bytes: the switch
+        # index, and its age in ms as of our poll.  An age of 255 means it's old.
+        iclose, t_close = None, None
+        if self._stamps and len(rsp) >= 3 + nb + nswb + 2 and rsp[-1] < 255:
+            iclose, t_close = rsp[-2], t_poll - rsp[-1] / 1000.0
         if self._ibs > 1: 
             self._sw_state = (rsp[ib0 + 1] << 8) | rsp[ib0]
         else:
             self._sw_state = rsp[ib0]
-        temp_cnts = self._split_bytes(rsp[ib1:ib1+nswb])
-        if not self._have_init_counts:
-            self._have_init_counts = True 
-            for i in range(self._nsw):
-                self._sw_counts[i] = temp_cnts[i]
-            return events 
-        # Generate new events, save the counts.
-        for i in range(self._nsw):
-            cnt = (temp_cnts[i] & 0x000F) - (self._sw_counts[i] & 0x000F) 
-            self._sw_counts[i] = temp_cnts[i] 
-            if cnt < 0: cnt += 16
+        cnt_bytes = bytes(rsp[ib1:ib1+nswb])
+        old_bytes = self._sw_count_bytes
+        self._sw_count_bytes = cnt_bytes
+        if old_bytes is None: return events 
+        # Generate events for the switches whose counters moved.  The closure with
+        # a reported time is the latest, so it goes after the others.
+        last_event = None
+        for i, cnt in sw_counts.count_deltas(old_bytes, cnt_bytes, self._nsw):
             for j in range(cnt):
-                event_name = self._designator + f"{i+1}"
-                events.append(event_name)
+                if i == iclose and j == cnt - 1: 
+                    last_event = HwEvent(self._ev_codes[i], t_close, t_poll, True)
+                else: 
+                    events.append(HwEvent(self._ev_codes[i], t_prev, t_poll))
+        if last_event is not None: events.append(last_event)
         return events
        
     def update(self):
         ''' Update the node, and return any new events.'''
-        global completed_cmds, dropped_cmds
         events = [] 
-        if comm is None: return events
+        if self._bus is None: return events
         if not self._active:
+            self._cmd_lock.acquire()
             if len(self._cmd_queue) > 0:
                 log(f"Node {self._name} is not active, {len(self._cmd_queue)} commands dropped.")
-                for id, _ in self._cmd_queue:
-                    dropped_cmds.append(id)
-                self._cmd_queue = [] 
+                for id in self._cmd_queue.clear(): self._tracker.dropped(id)
+                self._pending_keys = {}
+            if self._inflight is not None:
+                for id, _ in self._inflight[1]: self._tracker.dropped(id)
+                self._inflight = None
+            self._cmd_lock.release()
             if self._last_comm_success_time == 0: twait = 5 
             else: twait = 1.5 
             telp = time.monotonic() - self._last_comm_attemp_time
             if telp < twait: return events
         while(True):
-            dat = None 
-            id = -1
-            if len(self._cmd_queue) > 0: id, dat = self._cmd_queue.pop()
-            temp_events = self._attempt_comm(dat)
+            self._cmd_lock.acquire()
+            if self._inflight is not None:
+                dat, items, seq = self._inflight
+            elif self._seq_on and not self._seq_synced:
+                dat, items, seq = self._sync_frame()
+            else:
+                dat, items = self._take_commands()
+                dat, seq = self._seq_frame(dat)
+            self._cmd_lock.release()
+            temp_events = self._attempt_comm(dat, seq)
             if temp_events is None: 
-                # Try again, one time
-                temp_events = self._attempt_comm(dat)
+                # Try again right away.  Sequenced frames can be retried freely,
+                # since the node won't run them twice.  Others get one more try.
+                ntries = self._seq_retries if seq is not None else 1
+                for i in range(ntries):
+                    temp_events = self._attempt_comm(dat, seq)
+                    if temp_events is not None: break
                 if temp_events is None:
-                    if dat is not None: self._cmd_queue.append((id, dat))
+                    if seq is not None:
+                        # The node may have it already, so send the same frame
+                        # and seq next time.  Putting the commands back would 
+                        # give them a new seq.
+                        self._inflight = (dat, items, seq)
+                        return events
+                    # Put the commands back, in their original order.
+                    self._cmd_lock.acquire()
+                    self._requeue(items)
+                    self._cmd_lock.release()
                     return events 
-            if id != -1:
-                completed_cmds.append(id)
+            self._inflight = None
+            self._cmd_lock.acquire()
+            self._cmd_queue.done(items)
+            self._cmd_lock.release()
+            if seq is not None and not self._acked:
+                log(f"Node {self._name} did not acknowledge seq {seq}.  {len(items)} commands dropped.")
+                for id, _ in items: self._tracker.dropped(id)
+            else:
+                if seq is not None: self._seq_synced = True
+                for id, _ in items:
+                    self._tracker.completed(id)
             events.extend(temp_events)
             if len(self._cmd_queue) == 0: return events
  
+class BusSegment():
+    '''One RS-485 segment: its CommBus, the nodes wired to it, and the scheduler 
+    and io thread that poll them.  Segments are polled independently, so each 
+    one adds a link's worth of throughput.'''
+    def __init__(self, name, bus, scheduler):
+        self.name = name
+        self.bus = bus
+        self.nodes = {}
+        self.scheduler = scheduler 
+        self.broadcasts = []
+        self.io_thread = None
+        self.io_loops = 0
+        self.io_t0 = time.monotonic()
+        self.last_cycles = 0
+        self.last_report_t = time.monotonic()
+
+def _make_bus(port, tx_enable_pin):
+    bus = comm_bus.CommBus(port, tx_enable_pin)
+    bus.set_tx_mode(config.get_param("comm_bus", "tx_mode", "sleep"))
+    bus.set_rx_mode(config.get_param("comm_bus", "rx_mode", "spin"))
+    bus.set_tuning(config.get_param("comm_bus", "tuning", False))
+    gap_min = config.get_param("comm_bus", "gap_min", 0.001)
+    gap_max = config.get_param("comm_bus", "gap_max", 0.010)
+    adaptive = config.get_param("comm_bus", "adaptive_gap", False)
+    floors = config.get_param("comm_bus", "gap_floors", {})
+    bus.set_gaps(gap_min, gap_max, adaptive, floors)
+    bus.set_stats_window(config.get_param("comm_bus", "stats_window", 500))
+    nerrs = config.get_param("comm_bus", "fallback_errs", 10)
+    ncycles = config.get_param("comm_bus", "fallback_window", 200)
+    bus.set_fallback(nerrs, ncycles)
+    bus.begin()
+    return bus
+
+def _make_scheduler():
+    kind = config.get_param("hardware", "scheduler", "round_robin")
+    rates = config.get_param("hardware", "poll_rates", {})
+    priorities = config.get_param("hardware", "poll_priorities", {})
+    boost = config.get_param("hardware", "activity_boost", 2.0)
+    boost_time = config.get_param("hardware", "boost_time", 2.0)
+    max_visits = config.get_param("hardware", "max_visits", 4)
+    return poll_scheduler.make_scheduler(kind, rates, priorities, boost, boost_time, max_visits)
+
+class _StartupNode():
+    '''Where one node is in the startup pipeline.'''
+    def __init__(self, addr, t0):
+        self.addr = addr
+        if addr in nodes: self.name = nodes[addr]['name']
+        else: self.name = f"<Unknown>"
+        self.cmds = []
+        self.names = []
+        self.always = []            # For each command, if it is sent even when the node has its config
+        self.cfg = None             # The config plan being given to the node, to save if it all goes
+        self.sent = 0
+        self.fails = 0              # Failures in a row
+        self.next_t = t0            # When to try again
+        self.last_ok_t = t0         # When the node last answered (or startup began)
+        self.broken = False
+        self.t_done = None
+
+    def finished(self):
+        return self.broken or self.sent >= len(self.cmds)
+
+    def state(self):
+        if self.broken: return "failed"
+        if self.sent >= len(self.cmds): return "done"
+        if self.fails > 0: return "retrying"
+        return "sending"
+
 class Hardware():
     def __init__(self):
-        if comm is not None: comm.begin()
         self._event_lock = threading.Lock() 
         self._cmd_queue_lock = threading.Lock()
+        self._tracker = cmd_tracker.CommandTracker(config.get_param("hardware", "tracked_cmds", 1000))
+        self._segments = []
         self._nodes = {}
-        for node_adr in nodes:
-            self._nodes[node_adr] = Node(node_adr)
+        self._setup_segments()
+        self._io_thread_run = False
+        self._threaded = False
         self._events = [] 
         self._simulated_events = [] 
         self._last_key = None
@@ -175,79 +507,409 @@ class Hardware():
         self._major_keys = (pyg.K_t, pyg.K_l, pyg.K_f, pyg.K_b, pyg.K_k)
         self._major_key_map = {pyg.K_t: "T", pyg.K_l: "L", pyg.K_f: "F", pyg.K_b: "B", pyg.K_k: "K" }
         self._startup_cmds = []
+        for addr in config.get_param("hardware", "timestamp_nodes", []):
+            self.send_startup_cmd(addr, [CMD_STAMPS, 1], "closure stamps on")
+        self._latency_window = config.get_param("comm_bus", "stats_window", 500)
+        self._sw_latency = {}    # Event name -> closure to processing times, in ms
+        self._board = switch_board.SwitchBoard()
+
+    def _setup_segments(self):
+        # Builds the bus segments from the config, and the nodes on them.  Nodes
+        # that aren't in any segment go on the first.  Without real hardware, 
+        # there are no segments, and the nodes have no bus.
+        if comm_bus is None:
+            for node_adr in nodes:
+                self._nodes[node_adr] = Node(node_adr, self._cmd_queue_lock, None, self._tracker)
+            return
+        default = {"main": {"port": "/dev/ttyAMA0", "tx_enable_pin": 12, "nodes": list(nodes)}}
+        segs = config.get_param("comm_bus", "segments", default)
+        for name in segs:
+            seg = segs[name]
+            bus = _make_bus(seg["port"], seg.get("tx_enable_pin", None))
+            self._segments.append(BusSegment(name, bus, _make_scheduler()))
+        for node_adr in nodes:
+            segment = self._segments[0]
+            for sg in self._segments:
+                if node_adr in segs[sg.name]["nodes"]: segment = sg
+            node = Node(node_adr, self._cmd_queue_lock, segment.bus, self._tracker)
+            self._nodes[node_adr] = node
+            segment.nodes[node_adr] = node
+        for sg in self._segments: 
+            sg.bus.set_nodes(sg.nodes)
+            log(f"Bus segment {sg.name} on {sg.bus.port()}: nodes {list(sg.nodes)}")
 
-    def send_command(self, addr, dat):
+    def _bus_for(self, addr):
+        if addr in self._nodes: return self._nodes[addr]._bus
+        if len(self._segments) > 0: return self._segments[0].bus
+        return None
+
+    def send_command(self, addr, dat, priority=PRI_GAMEPLAY, callback=None):
         '''Queue's a command to be sent to a node on the next update.  Does not block. 
         Returns an id for the command so that the caller can check if it was successfully 
-        sent at a later time by polling command_done(). '''
-        id = self._nodes[addr].queue_command(dat)
+        sent at a later time by polling command_done(), or get a Future for it with
+        command_future().  Or, give a callback, which is called with True when the 
+        command is sent, or False if it is dropped.  Callbacks run on the thread that
+        polls the nodes (the io thread, if it is on).  Priority is PRI_SAFETY, 
+        PRI_GAMEPLAY or PRI_COSMETIC.  Higher priority commands go first, and 
+        cosmetic ones are dropped if they wait too long.  Safe to call while the
+        io thread is running. '''
+        self._cmd_queue_lock.acquire()
+        id = self._nodes[addr].queue_command(dat, priority)
+        self._cmd_queue_lock.release()
+        if callback is not None: self._tracker.watch(id, callback)
+        self._tracker.notify()
         return id
 
-    def send_startup_cmd(self, addr, cmd, name=""):
+    def command_future(self, id):
+        '''Returns a concurrent.futures.Future for a command, whose result is True when
+        it is sent, or False if it is dropped.  For example, to wait for a coil:
+        hw.command_future(hw.send_command(addr, cmd)).result(timeout=0.1)
+        Only block on it like that when the io thread is on.  Without it, commands
+        are only sent by update(), so waiting on the thread that calls update()
+        always times out; check done() on a later frame instead.  A future for an
+        unknown id, or one finished so long ago it was forgotten, fails at once
+        with a KeyError.'''
+        return self._tracker.future(id)
+
+    def broadcast_command(self, dat, fallback=None):
+        '''Queues a command for every node at once.  It goes out in one frame, that
+        no node answers, ahead of everything else on the next update.  Fallback is
+        an optional map of node address to a list of commands.  Those nodes are 
+        checked on their next poll, and if they missed the broadcast, the commands
+        are sent to them directly.  Safe to call while the io thread is running.'''
+        if fallback is None: fallback = {}
+        self._cmd_queue_lock.acquire()
+        for segment in self._segments: segment.broadcasts.append((dat, fallback))
+        self._cmd_queue_lock.release()
+
+    def _send_broadcasts(self, segment):
+        self._cmd_queue_lock.acquire()
+        bcasts = segment.broadcasts
+        segment.broadcasts = []
+        self._cmd_queue_lock.release()
+        active_nodes = config.get_active_nodes()
+        for dat, fallback in bcasts:
+            okay = segment.bus.broadcast(dat)
+            self._cmd_queue_lock.acquire()
+            for addr in fallback:
+                if not addr in active_nodes or not addr in segment.nodes: continue
+                node = segment.nodes[addr]
+                if okay: node.expect_broadcast(fallback[addr])
+                else: 
+                    for cmd in fallback[addr]: node.queue_command(cmd, PRI_SAFETY)
+            self._cmd_queue_lock.release()
+
+    def send_startup_cmd(self, addr, cmd, name="", always=False):
         '''Queues a command that MUST be executed at startup before regular games can
         be played.  This is suitable for configuration commands that must be executed
-        for safe play.  After all the startup commands are queued, call conduct_startup(). '''
-        self._startup_cmds.append((addr, cmd, name))
+        for safe play.  After all the startup commands are queued, call conduct_startup(). 
+        Nodes that keep a config hash are not sent commands they already have, unless
+        always is true.  Use always for commands that set state, not config, such as
+        disabling coils.'''
+        self._startup_cmds.append((addr, cmd, name, always))
 
-    def conduct_startup(self):
-        '''Issues all the startup commands.  Will block until entire queue is empty.  If
-        the queue cannot be competed, due to some hardware failure -- will return 
-        a displayable error.  Otherwise None is returned. '''
-        ncnt = 0
+    def conduct_startup(self, progress=None):
+        '''Issues all the startup commands.  Will block until they are all sent, or
+        until every node that isn't done has failed.  Commands for different nodes are
+        interleaved, so a slow or missing node doesn't hold up the others.  A node
+        that doesn't answer is retried after a wait that doubles each time, and is 
+        failed if it stays quiet for startup_node_timeout, or if the whole startup
+        passes startup_deadline.  If progress is given, it is called now and then
+        with a list of (node name, commands sent, commands total, state), where state
+        is "sending", "retrying", "done" or "failed".  If the queue cannot be 
+        completed, due to some hardware failure -- will return a displayable error.
+        Otherwise None is returned. '''
         t0 = time.monotonic()
-        errtxt = None
+        deadline = t0 + config.get_param("hardware", "startup_deadline", 3.0)
+        node_timeout = config.get_param("hardware", "startup_node_timeout", 1.0)
+        backoff = config.get_param("hardware", "startup_backoff", 0.005)
+        backoff_max = config.get_param("hardware", "startup_backoff_max", 0.2)
         active_nodes = config.get_active_nodes()
-        broken_nodes = []
-        for addr, cmd, name in self._startup_cmds:
+        plan = {}
+        for addr, cmd, name, always in self._startup_cmds:
             if not addr in active_nodes: continue
-            if addr in broken_nodes: continue
-            tstart = time.monotonic()
-            while True:
-                if comm is None: rsp = []
-                else: rsp = comm.node_io(addr, cmd)
-                if rsp is not None:
-                    if addr in nodes: node_name = nodes[addr]['name']
-                    else: node_name = f"<Unknown>"
-                    log(f"Startup Command Issued on node {node_name}: {name}")
-                    break 
-                if time.monotonic() - tstart > 2.0:
-                    if addr in nodes: node_name = nodes[addr]['name']
-                    else: node_name = f"<Unknown>"
-                    log(f"Startup Command FAILED on node {node_name}: {name} ")
-                    errtxt = f"Node {addr} ({node_name}) not responding."
-                    broken_nodes.append(addr)
-                    break  # we try to issue all commands to other nodes, even on errors
-            ncnt += 1
+            if not addr in plan: plan[addr] = _StartupNode(addr, t0)
+            plan[addr].cmds.append(cmd)
+            plan[addr].names.append(name)
+            plan[addr].always.append(always)
+        for addr in plan:
+            if addr in self._nodes: self._nodes[addr].resync()
+        saved_plans = cfg_plan.load_plans()
+        nframes = self._check_cfg_hashes(plan, saved_plans)
+        t_progress = 0.0
+        changed = True
+        while True:
+            tnow = time.monotonic()
+            if progress is not None and changed and tnow - t_progress > 0.1:
+                progress([(sn.name, sn.sent, len(sn.cmds), sn.state()) for sn in plan.values()])
+                t_progress = tnow
+                changed = False
+            waiting = [sn for sn in plan.values() if not sn.finished()]
+            if len(waiting) == 0: break
+            if tnow > deadline:
+                for sn in waiting: sn.broken = True
+                break
+            due = [sn for sn in waiting if sn.next_t <= tnow]
+            if len(due) == 0:
+                time.sleep(max(0.0, min(sn.next_t for sn in waiting) - tnow))
+                continue
+            for sn in due:
+                node = self._nodes.get(sn.addr)
+                todo = sn.cmds[sn.sent:]
+                if node is None: dat, n = todo[0], 1
+                else: dat, n = node.pack_startup(todo)
+                bus = self._bus_for(sn.addr)
+                if bus is None: rsp = []
+                else: rsp = bus.node_io(sn.addr, dat)
+                nframes += 1
+                tnow = time.monotonic()
+                if rsp is None:
+                    if tnow - sn.last_ok_t > node_timeout: 
+                        sn.broken = True
+                        changed = True
+                        continue
+                    sn.next_t = tnow + min(backoff_max, backoff * (2 ** sn.fails))
+                    if sn.fails == 0: changed = True
+                    sn.fails += 1
+                    continue
+                for name in sn.names[sn.sent:sn.sent + n]:
+                    log(f"Startup Command Issued on node {sn.name}: {name}")
+                sn.sent += n
+                sn.fails = 0
+                sn.next_t = tnow
+                sn.last_ok_t = tnow
+                if sn.sent >= len(sn.cmds): sn.t_done = tnow - t0
+                changed = True
+        errtxt = None
+        ncnt = 0
+        broken_nodes = []
+        for sn in plan.values():
+            ncnt += sn.sent
+            if sn.broken:
+                log(f"Startup Command FAILED on node {sn.name}: {sn.names[sn.sent]} ({len(sn.cmds) - sn.sent} not sent)")
+                errtxt = f"Node {sn.addr} ({sn.name}) not responding."
+                broken_nodes.append(sn.addr)
+            else:
+                if sn.t_done is None: sn.t_done = 0.0
+                log(f"Startup of node {sn.name} done in {sn.t_done:.3f} seconds.")
+                if sn.cfg is not None: saved_plans[sn.addr] = sn.cfg
+        if progress is not None and changed:
+            progress([(sn.name, sn.sent, len(sn.cmds), sn.state()) for sn in plan.values()])
         telp = time.monotonic() - t0
-        log(f"{ncnt} startup commands successfully issued in {telp:.2f} seconds.")
+        log(f"{ncnt} startup commands successfully issued in {nframes} frames, {telp:.2f} seconds.")
+        if any(sn.cfg is not None and not sn.broken for sn in plan.values()): cfg_plan.save_plans(saved_plans)
+        self._negotiate_rates(broken_nodes)
         return errtxt
 
-    def command_done(id):
+    def _check_cfg_hashes(self, plan, saved_plans):
+        # For the nodes that keep a config hash, takes out the startup commands
+        # the node already has, and if it needs any, ends its list with setting 
+        # the new hash.  Returns the number of frames used.
+        hash_nodes = config.get_param("hardware", "cfg_hash_nodes", [])
+        nframes = 0
+        for sn in plan.values():
+            if not sn.addr in hash_nodes: continue
+            icfg = [i for i in range(len(sn.cmds)) if not sn.always[i]]
+            cfg = [sn.cmds[i] for i in icfg]
+            want = cfg_plan.plan_hash(cfg)
+            have = self._get_cfg_hash(sn.addr)
+            nframes += 3
+            old = saved_plans.get(sn.addr)
+            if have == want: send = []
+            elif have is not None and old is not None and have == cfg_plan.plan_hash(old): 
+                send = cfg_plan.changed_cmds(old, cfg)
+            else: send = list(range(len(cfg)))
+            if have is None: log(f"Node {sn.name} did not give its config hash.  Sending all its config.")
+            else: log(f"Node {sn.name} config hash {have:04X}, want {want:04X}: sending {len(send)} of {len(cfg)} config commands.")
+            keep = set(icfg[j] for j in send)
+            keep.update(i for i in range(len(sn.cmds)) if sn.always[i])
+            sn.cmds = [sn.cmds[i] for i in sorted(keep)]
+            sn.names = [sn.names[i] for i in sorted(keep)]
+            if have != want:
+                sn.cmds.append([cfg_plan.CMD_SET_CFG_HASH, want & 0x00FF, want >> 8])
+                sn.names.append(f"config hash {want:04X}")
+                sn.cfg = cfg
+        return nframes
+
+    def _get_cfg_hash(self, addr):
+        # Asks a node for its config hash.  Returns None if it doesn't answer.
+        # A node's reply is loaded before it runs the frame's command, so each
+        # byte comes back in the reply to the frame after the one asking for it.
+        bus = self._bus_for(addr)
+        if bus is None: return None
+        h = 0
+        for i, ibyte in enumerate((0, 1, 1)):
+            # The reply is only good until the next node_io(), so take the byte now.
+            rsp = bus.node_io(addr, [cfg_plan.CMD_GET_CFG_HASH, ibyte])
+            if rsp is None or len(rsp) < 3: return None
+            if i > 0: h |= rsp[2] << (8 * (i - 1))
+        return h
+
+    def _negotiate_rates(self, broken_nodes):
+        # Speeds up each segment, if allowed in the config.  Only done when
+        # every active node on the segment is working.
+        allowed = config.get_param("comm_bus", "baud_rates", [])
+        if len(allowed) <= 1: return
+        active_nodes = config.get_active_nodes()
+        for segment in self._segments:
+            addrs = [a for a in segment.nodes if a in active_nodes]
+            if len(addrs) == 0: continue
+            if any(a in broken_nodes for a in addrs): 
+                log(f"Bus segment {segment.name} has nodes not responding.  Not changing its speed.")
+                continue
+            segment.bus.negotiate(addrs, allowed)
+
+    def command_done(self, id):
         '''Returns true if the command was successfully sent.  If so, thereafter the same
         id will return false.  If the command has not been successfully sent thus far, false is 
-        returned.''' 
-        global completed_cmds
-        if id in completed_cmds:
-            completed_cmds.remove(id) 
-            return True
-        return False
-
-    def command_dropped(id):
+        returned.  Only the most recent finished commands are remembered (tracked_cmds in the config).''' 
+        return self._tracker.take(id, cmd_tracker.DONE)
+
+    def command_dropped(self, id):
         '''Returns true if the command was dropped.  If so, thereafter the same id will return
         false.  If the command was not dropped thus far, false is returned.'''
-        global dropped_cmds
-        if id in dropped_cmds:
-            dropped_cmds.remove(id)
-            return True 
-        return False
+        return self._tracker.take(id, cmd_tracker.DROPPED)
 
     def report_to_log(self):
-        if comm is None: return None
-        cmap = comm.report()
-        s = "" 
+        if len(self._segments) == 0: return None
+        total_rate = 0.0
+        for segment in self._segments: total_rate += self._report_segment(segment)
+        if len(self._segments) > 1: 
+            log(f"All {len(self._segments)} Segments: {total_rate:.1f} Bus Cycles/s")
+        saved = ""
+        for node_adr in self._nodes:
+            n = self._nodes[node_adr].frames_saved()
+            if n > 0: saved += f"{node_adr}:{n} "
+        if saved != "": log(f"Frames saved by coalescing: {saved}")
+        depths, peaks, stale = "", "", ""
+        self._cmd_queue_lock.acquire()
+        for node_adr in self._nodes:
+            qr = self._nodes[node_adr].queue_report()
+            depths += f"{node_adr}:" + "/".join(str(qr[k]["depth"]) for k in cmd_queue.level_names) + " "
+            peaks += f"{node_adr}:" + "/".join(str(qr[k]["peak"]) for k in cmd_queue.level_names) + " "
+            if qr["stale_drops"] > 0: stale += f"{node_adr}:{qr['stale_drops']} "
+        self._cmd_queue_lock.release()
+        if self._threaded: log(f"Events Waiting: {len(self._events)}")
+        log(f"Cmd Queues (safety/gameplay/cosmetic): {depths}  Peaks: {peaks}  Pending: {self._tracker.pending_count()}")
+        if stale != "": log(f"Stale cosmetic commands dropped: {stale}")
+        self._event_lock.acquire()
+        s = ""
+        for name in sorted(self._sw_latency):
+            lat = self._sw_latency[name].summary()
+            s += f"{name}:{lat['p50']:.1f}/{lat['p95']:.1f}/{lat['max']:.1f}  "
+        self._event_lock.release()
+        if s != "": log(f"Switch Latency p50/p95/max (ms): {s}")
+
+    def _report_segment(self, segment):
+        # Logs the stats for one segment.  Returns its bus cycles per second
+        # since the last report.
+        cmap = segment.bus.report()
+        tnow = time.monotonic()
+        cycles = cmap["Bus Cycles"]
+        rate = (cycles - segment.last_cycles) / (tnow - segment.last_report_t)
+        segment.last_cycles = cycles
+        segment.last_report_t = tnow
+        s = f"[{segment.name}] Bus Cycles/s: {rate:.1f}   " 
         for k in cmap:
+            if k.startswith("Node "): continue
             s += f"{k}: {cmap[k]}   "
         log(s)
+        for k in cmap:
+            if k.startswith("Node "): log(f"[{segment.name}] {k}: {cmap[k]}")
+        smap = segment.scheduler.report()
+        s = f"[{segment.name}] "
+        for k in smap:
+            s += f"{k}: {smap[k]}   "
+        log(s)
+        if segment.io_thread is not None:
+            telp = tnow - segment.io_t0
+            loop_rate = segment.io_loops / telp
+            segment.io_loops = 0
+            segment.io_t0 = tnow
+            log(f"[{segment.name}] IO Thread Loop Rate: {loop_rate:.1f}/s")
+        return rate
+
+    def snapshot(self):
+        '''Returns the bus stats, and the state of the command queues, as a map of
+        plain data.  See CommBus.snapshot() for the bus part.  Returns None if there
+        is no bus.'''
+        if len(self._segments) == 0: return None
+        snap = {"segments": {}, "nodes": {}}
+        for segment in self._segments:
+            ss = segment.bus.snapshot()
+            for addr, ns in ss.pop("nodes").items():
+                ns["segment"] = segment.name
+                snap["nodes"][addr] = ns
+            snap["segments"][segment.name] = ss
+        self._cmd_queue_lock.acquire()
+        for addr in self._nodes:
+            ns = snap["nodes"].setdefault(addr, {})
+            ns["queue_depth"] = self._nodes[addr].queue_depth()
+            ns["queue_levels"] = self._nodes[addr].queue_report()
+            ns["frames_saved"] = self._nodes[addr].frames_saved()
+        self._cmd_queue_lock.release()
+        self._event_lock.acquire()
+        snap["switch_latency_ms"] = {name: st.summary() for name, st in self._sw_latency.items()}
+        self._event_lock.release()
+        return snap
+
+    def start_io_thread(self):
+        '''Starts a background thread for each bus segment that polls its nodes 
+        continuously, if enabled in the config.  After this, update() only handles
+        simulated events, and the game loop no longer waits on the bus.  Call
+        after conduct_startup().'''
+        if len(self._segments) == 0 or self._threaded: return 
+        if not config.get_param("hardware", "io_thread", False): return
+        self._io_thread_run = True
+        self._threaded = True
+        for segment in self._segments:
+            segment.io_loops = 0
+            segment.io_t0 = time.monotonic()
+            segment.io_thread = threading.Thread(target=self._io_loop, args=(segment,), name=f"bus_io_{segment.name}", daemon=True)
+            segment.io_thread.start()
+        log(f"Hardware IO threads started for {len(self._segments)} bus segments.")
+
+    def stop_io_thread(self):
+        '''Stops the io threads, waiting for each to finish its current pass.'''
+        if not self._threaded: return
+        self._io_thread_run = False 
+        for segment in self._segments:
+            segment.io_thread.join()
+            segment.io_thread = None
+        self._threaded = False
+        log("Hardware IO threads stopped.")
+
+    def _io_loop(self, segment):
+        while self._io_thread_run:
+            t0 = time.monotonic()
+            events = self._poll_nodes(segment)
+            if len(events) > 0:
+                self._event_lock.acquire() 
+                self._events.extend(events)
+                self._event_lock.release() 
+            segment.io_loops += 1
+            # Don't spin if there was nothing to do (no active nodes).
+            if time.monotonic() - t0 < 0.001: time.sleep(0.001)
+
+    def _poll_nodes(self, segment):
+        events = []
+        # Skip a segment that is falling back to the base rate.  Its nodes
+        # need the bus quiet for a moment.
+        if segment.bus.settling(): return events
+        if len(segment.broadcasts) > 0: self._send_broadcasts(segment)
+        visited = segment.scheduler.next_pass(segment.nodes, time.monotonic())
+        for node_adr in visited:
+            temp_events = segment.nodes[node_adr].update()
+            segment.scheduler.on_visit(node_adr, len(temp_events), time.monotonic())
+            events.extend(temp_events)
+        self._event_lock.acquire()
+        for node_adr in visited:
+            node = segment.nodes[node_adr]
+            if node.switch_count() == 0: continue
+            self._board.set_node(node.designator(), node.get_switch_state(), node.last_poll_time())
+        self._event_lock.release()
+        self._tracker.notify()
+        return events
     
     def update(self):
         events = [] 
@@ -255,24 +917,38 @@ class Hardware():
         if self._simulated_events is not None:
             events.extend(self._simulated_events)
             self._simulated_events = []
-        # Now, talk to real nodes...
-        for node_adr in self._nodes:
-            temp_events = self._nodes[node_adr].update()
-            events.extend(temp_events)
+        # Now, talk to real nodes, unless the io thread is doing it.
+        if not self._threaded: 
+            for segment in self._segments: events.extend(self._poll_nodes(segment))
         self._event_lock.acquire() 
         self._events.extend(events)
+        self._board.latch()
         self._event_lock.release() 
 
     def get_events(self):
-        '''Returns a list of new events since last call.'''
+        '''Returns a list of new events since last call.  They are taken to be 
+        processed now, which is what the switch latency stats measure.'''
         self._event_lock.acquire() 
         xout = self._events
         self._events = []
+        tnow = time.monotonic()
+        for e in xout:
+            if not e.exact: continue
+            name = str(e)
+            if name not in self._sw_latency: self._sw_latency[name] = bus_stats.RollingStats(self._latency_window)
+            self._sw_latency[name].add((tnow - e.t_closure) * 1000.0)
         self._event_lock.release() 
         return xout
 
+    def switches(self):
+        '''Returns the switch board: the state of every switch on the machine as of
+        the last update(), and what changed in that update.  See switch_board.py.
+        For use on the game thread, which calls update().'''
+        return self._board
+
     def get_switch_state(self, node_addr):
-        '''Returns a bitmap of the switches for a given node'''
+        '''Returns a bitmap of the switches for a given node, as of the last reply.
+        Most callers want switches() instead.'''
         if node_addr in self._nodes:
             bits = self._nodes[node_addr].get_switch_state()
             return bits 
@@ -287,7 +963,8 @@ class Hardware():
         if self._last_key is not None:
             for i, k in enumerate(self._key_digits):
                 if k == key: 
-                    self._simulated_events.append(self._major_key_map[self._last_key] + f"{i+1:1}")
+                    code = hw_events.code_for_name(self._major_key_map[self._last_key] + f"{i+1:1}")
+                    if code is not None: self._simulated_events.append(HwEvent(code))
                     return 
         
 if __name__ == "__main__":
@@ -33,9 +33,9 @@ class Kickers():
 
     def queue_startup_cmds(self):
         cmd = [CMD_COILS_ENABLE, MASK_ALL_KICKERS, 0]
-        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all kickers coils")
+        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all kickers coils", always=True)
         cmd = [CMD_LAMP_ENABLE, MASK_ALL_LAMPS, 0]
-        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all kickers lamps")
+        self._hw.send_startup_cmd(self._nodeadr, cmd, "disable all kickers lamps", always=True)
 
         pwm= config.get_param('kicker_top', 'pwm', 150)
         t_on = config.get_param('kicker_top', 'on_time', 100)
@@ -92,12 +92,15 @@ class Kickers():
             else: name = ""
             log(f"Sending Queued Command from Kickers: {name}")
 
+    def disable_cmds(self):
+        '''Returns the commands that disable all the kicker coils and lamps.'''
+        return [[CMD_COILS_ENABLE, MASK_ALL_KICKERS, 0], [CMD_LAMP_ENABLE, MASK_ALL_LAMPS, 0]]
+
     def disable(self):
-        cmd = [CMD_COILS_ENABLE, MASK_ALL_KICKERS, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        cmd_coils, cmd_lamps = self.disable_cmds()
+        self._hw.send_command(self._nodeadr, cmd_coils, hardware.PRI_SAFETY)
         log("Sending Command from Kickers: Disabling all Coils")
-        cmd = [CMD_LAMP_ENABLE, MASK_ALL_LAMPS, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd_lamps, hardware.PRI_SAFETY)
         log("Sending Command from Kickers: Disabling all Lamps")
 
     def enable(self):
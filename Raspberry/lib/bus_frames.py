@@ -0,0 +1,187 @@
+#  bus_frames.py -- Frame encoding and decoding for the comm bus
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  A frame on the RS-485 bus looks like this:
+#    Byte 0:     Sync byte. 'E' when sent by the Pi, 'e' when sent by a node.
+#    Byte 1:     Node address (upper nibble) and payload length (lower nibble).
+#    Byte 2-n:   Payload, up to 15 bytes.
+#    Last byte:  Checksum -- the sum of all the previous bytes, mod 256.
+#
+#  Frames from the Pi to address 15 are broadcasts: every node takes
+#  them, and none of them answer.
+#
+#  The codec keeps one transmit and one receive buffer per node, allocated
+#  the first time the node is used, so that nothing big is allocated on
+#  each bus cycle.  Payloads are handed back as memoryview slices into the
+#  receive buffer.  A payload is only good until the next cycle on the
+#  same node -- copy it if it needs to live longer.
+
+SYNC_HOST = ord('E')
+SYNC_NODE = ord('e')
+MAX_PAYLOAD = 15
+MAX_FRAME = MAX_PAYLOAD + 3
+BROADCAST_ADDR = 15
+CMD_POLL_DELTA = 104    # Poll answered with only the three count bytes if the switches have no news
+
+def checksum(mv, n):
+    ''' Returns the checksum of the first n bytes in mv.  For speed, mv
+    should be a memoryview.'''
+    return sum(mv[:n]) & 0x00FF
+
+class FrameCodec():
+    ''' Encodes outgoing frames and decodes incoming frames, using
+    preallocated buffers for each node.'''
+    def __init__(self):
+        self._tx_bufs = {}
+        self._rx_bufs = {}
+
+    def _buffers(self, table, addr):
+        bufs = table.get(addr)
+        if bufs is None:
+            buf = bytearray(MAX_FRAME)
+            bufs = (buf, memoryview(buf))
+            table[addr] = bufs
+        return bufs
+
+    def encode(self, addr, data=None):
+        ''' Builds a frame for the given node and payload.  Returns a memoryview
+        of the complete frame, which is only valid until the next encode() for
+        the same node.  Raises ValueError if the payload is over 15 bytes.'''
+        buf, mv = self._buffers(self._tx_bufs, addr)
+        if data is None: ndat = 0
+        else: ndat = len(data)
+        if ndat > MAX_PAYLOAD: raise ValueError
+        buf[0] = SYNC_HOST
+        buf[1] = (addr << 4 | ndat) & 0x00FF
+        if ndat > 0:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                mv[2:ndat + 2] = data
+            else:
+                for i, v in enumerate(data):
+                    buf[i + 2] = v & 0x00FF
+        buf[ndat + 2] = sum(mv[:ndat + 2]) & 0x00FF
+        return mv[:ndat + 3]
+
+    def rx_buffer(self, addr):
+        ''' Returns the receive buffer (a bytearray) for a node.  The caller
+        fills it with a frame and then calls decode().'''
+        buf, _ = self._buffers(self._rx_bufs, addr)
+        return buf
+
+    def decode(self, addr, nframe, checked=False):
+        ''' Checks the frame of nframe bytes that has been placed in the
+        node's receive buffer.  Returns a memoryview of the payload, or
+        None if the checksum does not match.  If checked is true, the caller
+        has already checked the checksum, and it isn't done again.'''
+        buf, mv = self._buffers(self._rx_bufs, addr)
+        if not checked and sum(mv[:nframe - 1]) & 0x00FF != buf[nframe - 1]: return None
+        return mv[2:nframe - 1]
+
+class FrameParser():
+    ''' Incremental parser for the receive side of a bus cycle.  Bytes can
+    be fed in chunks of any size.  Garbage is skipped, and after a bad frame
+    the parser resyncs on the next 'e' or 'E', so that a good reply from the
+    node is not lost because of noise in front of it.  The echo of our own
+    message is dropped.  Bytes are parsed in place, from _i0 on, and only
+    thrown away between cycles, so that no slices are copied per frame. '''
+    def __init__(self, codec):
+        self._codec = codec
+        self._buf = bytearray()
+        self._i0 = 0             # Where the unparsed bytes start in _buf
+        self._addr = 0
+        self._err_in_cycle = False
+        self.last_error = ""
+        self.clear_counts()
+
+    def clear_counts(self):
+        self.sync_errs = 0       # Bytes thrown away while looking for a sync byte
+        self.addr_errs = 0       # Headers with an address other than the one we talked to
+        self.checksum_errs = 0   # Frames rejected due to checksum mismatch
+        self.echo_frames = 0     # Echos of our own message (normal with RS-485)
+        self.recovered = 0       # Good replies found after an error in the same cycle
+
+    def reset(self, addr):
+        ''' Starts a new bus cycle, where a reply is expected from addr.'''
+        del self._buf[:]
+        self._i0 = 0
+        self._addr = addr
+        self._err_in_cycle = False
+        self.last_error = ""
+
+    def bytes_needed(self):
+        ''' Returns the fewest bytes that must still arrive before feed() could
+        hand back the node's reply.  Used to avoid waking up for every byte.'''
+        buf = self._buf
+        i0 = self._i0
+        nbuf = len(buf) - i0
+        if nbuf < 2: return 3 - nbuf
+        c = buf[i0]
+        if c != SYNC_NODE and c != SYNC_HOST: return 1
+        n = (buf[i0 + 1] & 0x000F) + 3 - nbuf
+        if c == SYNC_HOST: n += 3   # The node's reply is still to come after our echo.
+        return max(n, 1)
+
+    def _error(self, msg):
+        self._err_in_cycle = True
+        self.last_error = msg
+
+    def feed(self, chunk):
+        ''' Adds received bytes to the parser.  Returns the payload (as a
+        memoryview) if the reply from the node is now complete, otherwise None.'''
+        buf = self._buf
+        if self._i0 == len(buf):
+            del buf[:]
+            self._i0 = 0
+        buf.extend(chunk)
+        # The buffer can't be resized while a view of it is held, so the view
+        # is let go before returning.
+        mv = memoryview(buf)
+        try:
+            return self._parse(buf, mv)
+        finally:
+            mv.release()
+
+    def _parse(self, buf, mv):
+        i0 = self._i0
+        n = len(buf)
+        while i0 < n:
+            c = buf[i0]
+            if c != SYNC_NODE and c != SYNC_HOST:
+                # Skip to the next possible start of a frame.
+                i1 = buf.find(SYNC_NODE, i0)
+                i2 = buf.find(SYNC_HOST, i0)
+                if i1 < 0: i = i2
+                elif i2 < 0: i = i1
+                else: i = min(i1, i2)
+                if i < 0: i = n
+                self.sync_errs += i - i0
+                self._error(f"Illegal first byte ({c})")
+                i0 = i
+                continue
+            if n - i0 < 2: break
+            addr = (buf[i0 + 1] >> 4) & 0x000F
+            if addr != self._addr:
+                self.addr_errs += 1
+                self._error(f"Wrong address in reply ({self._addr} != {addr})")
+                i0 += 1
+                continue
+            nframe = (buf[i0 + 1] & 0x000F) + 3
+            if n - i0 < nframe: break
+            icks = i0 + nframe - 1
+            if sum(mv[i0:icks]) & 0x00FF != buf[icks]:
+                self.checksum_errs += 1
+                self._error(f"Checksum fail on receive. Found {buf[icks]}.")
+                i0 += 1
+                continue
+            if c == SYNC_HOST:
+                # Just the echo of what we sent.
+                self.echo_frames += 1
+                i0 += nframe
+                continue
+            rx = self._codec.rx_buffer(addr)
+            rx[0:nframe] = mv[i0:i0 + nframe]
+            self._i0 = i0 + nframe
+            if self._err_in_cycle: self.recovered += 1
+            return self._codec.decode(addr, nframe, checked=True)
+        self._i0 = i0
+        return None
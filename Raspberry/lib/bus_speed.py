@@ -0,0 +1,57 @@
+#  bus_speed.py -- Bus speed negotiation rules
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Every segment starts at 115200 baud.  At startup, the Pi can ask each
+#  node what rates it can run at, and move the segment up to the fastest
+#  one they all have.  The node side works like this:
+#
+#  GET_RATES (102)  No args.  The node puts its rate mask (see mask_for)
+#                   in its echo register, which comes back in the reply to
+#                   the next frame.
+#  SET_RATE (103)   Arg: rate code.  The node answers at the old rate, then
+#                   switches.  If a node running faster than the base rate
+#                   goes REVERT_TIME secs without a good frame on the bus, it
+#                   goes back to the base rate on its own.  That is how the Pi
+#                   gets everyone back when the faster rate doesn't work out.
+#
+#  The comm_bus Arduino library does the rate switching.  The light nodes
+#  only give the base rate, since they can't take bytes while they update
+#  their pixels.  Nodes need firmware that knows these commands before the
+#  faster rates are allowed in config.py.
+
+BASE_RATE = 115200
+REVERT_TIME = 0.5
+
+CMD_ECHO = 100
+CMD_GET_RATES = 102
+CMD_SET_RATE = 103
+
+# Rate code, for SET_RATE, is the bit number in the rate mask.
+rates = (115200, 250000, 500000, 1000000)
+
+def rate_code(rate):
+    return rates.index(rate)
+
+def rate_from_code(code):
+    if code < 0 or code >= len(rates): return None
+    return rates[code]
+
+def mask_for(rate_list):
+    ''' Returns the rate mask for a list of rates.'''
+    mask = 0
+    for r in rate_list: mask |= 1 << rate_code(r)
+    return mask
+
+def rates_in_mask(mask):
+    ''' Returns the rates in a mask, slowest first.'''
+    return [r for i, r in enumerate(rates) if mask & (1 << i)]
+
+def best_common_rate(masks, allowed):
+    ''' Returns the fastest rate that every node can do (masks has one rate mask
+    per node) and that is in the allowed list.  The base rate if there isn't one.'''
+    common = mask_for([r for r in allowed if r in rates])
+    for m in masks: common &= m
+    best = BASE_RATE
+    for r in rates_in_mask(common):
+        if r > best: best = r
+    return best
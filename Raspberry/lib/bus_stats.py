@@ -0,0 +1,87 @@
+#  bus_stats.py -- Rolling timing stats for the comm bus
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Each bus cycle adds a few numbers to fixed size windows, which is
+#  cheap enough to leave on all the time.  The sorting needed for the
+#  percentiles is only done when a report is asked for.
+
+import collections
+
+class RollingStats():
+    ''' Keeps the last n values of something, and gives percentiles over them.'''
+    def __init__(self, n=500):
+        self._vals = collections.deque(maxlen=n)
+
+    def add(self, v):
+        self._vals.append(v)
+
+    def clear(self):
+        self._vals.clear()
+
+    def count(self):
+        return len(self._vals)
+
+    def mean(self):
+        if len(self._vals) == 0: return 0.0
+        return sum(self._vals) / len(self._vals)
+
+    def summary(self):
+        ''' Returns a map with the count, mean, p50, p95, p99 and max of the
+        values in the window.  Empty if there are none.'''
+        n = len(self._vals)
+        if n == 0: return {}
+        vals = sorted(self._vals)
+        def pct(p): return vals[min(n - 1, int(p * n / 100))]
+        return {"n": n, "mean": sum(vals) / n, "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": vals[-1]}
+
+class NodeBusStats():
+    ''' Timings for the bus cycles with one node.  Times are in usecs.
+        rtt   -- from turning on the transmitter to having the complete reply
+        tx    -- from turning on the transmitter to turning it off
+        wait  -- from turning off the transmitter to having the complete reply
+        nbytes -- bytes sent plus bytes received
+        short -- for each delta poll, 1 if the reply was short (no news)
+        cpu   -- cpu time used by the cycle, including failed ones
+    Failed cycles are otherwise only counted.'''
+    def __init__(self, n=500):
+        self.rtt = RollingStats(n)
+        self.tx = RollingStats(n)
+        self.wait = RollingStats(n)
+        self.nbytes = RollingStats(n)
+        self.cpu = RollingStats(n)
+        self.short = RollingStats(n)
+        self.fails = 0
+
+    def add(self, tx, wait, nbytes, short=None):
+        ''' Adds a good cycle.  Short is None unless the cycle was a delta poll.'''
+        self.rtt.add(tx + wait)
+        self.tx.add(tx)
+        self.wait.add(wait)
+        self.nbytes.add(nbytes)
+        if short is not None: self.short.add(1 if short else 0)
+
+    def clear(self):
+        for s in (self.rtt, self.tx, self.wait, self.nbytes, self.cpu, self.short): s.clear()
+        self.fails = 0
+
+    def snapshot(self):
+        return {"fails": self.fails, "rtt_us": self.rtt.summary(), "tx_us": self.tx.summary(),
+                "wait_us": self.wait.summary(), "bytes": self.nbytes.summary(), "cpu_us": self.cpu.summary(),
+                "short_pct": self.short_pct()}
+
+    def short_pct(self):
+        ''' Returns the percent of recent delta polls that got a short reply.'''
+        return 100.0 * self.short.mean()
+
+    def report(self):
+        ''' Returns a short one line summary for the log.'''
+        rtt = self.rtt.summary()
+        if len(rtt) == 0: return f"no replies, fails={self.fails}"
+        wait = self.wait.summary()
+        nb = self.nbytes.summary()
+        s = f"rtt p50/p95/p99={rtt['p50']}/{rtt['p95']}/{rtt['p99']}us "
+        s += f"wait p50/p99={wait['p50']}/{wait['p99']}us bytes={nb['mean']:.1f} fails={self.fails}"
+        cpu = self.cpu.summary()
+        if len(cpu) > 0: s += f" cpu={cpu['mean']:.0f}us"
+        if self.short.count() > 0: s += f" short={self.short_pct():.0f}%"
+        return s
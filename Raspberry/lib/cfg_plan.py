@@ -0,0 +1,78 @@
+#  cfg_plan.py -- Startup config plans, and the config hash handshake
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  A node's startup config is the list of commands queued for it with
+#  send_startup_cmd().  Laid end to end as (len, cmd bytes...) they make
+#  a canonical byte plan, and its CRC is the plan's hash.  The node keeps
+#  the hash of the last plan it was given:
+#
+#  GET_CFG_HASH (105)  Arg: byte index (0 = low, 1 = high).  The node puts
+#                      that byte of its config hash in its echo register,
+#                      which shows in the reply to the next frame.
+#  SET_CFG_HASH (106)  Args: hash low, hash high.  Sent once the node has
+#                      taken every command in the plan.
+#
+#  A node that has just powered up has a hash of zero, which no plan has.
+#  The Pi saves the last plan it gave each node, so when the node still
+#  has that plan's hash, only the commands that differ from it are sent.
+#  Nodes need firmware that knows these commands before this is turned on
+#  for them in config.py.
+
+import json
+import binascii
+import common
+
+CMD_GET_CFG_HASH = 105
+CMD_SET_CFG_HASH = 106
+
+if common.platform() == "real":
+    plan_file_path = "/home/pi/pb/logs/cfg_plans.json"
+else:
+    plan_file_path = "C:\\Users\\dalbr\\Documents\\Projects\\Epic_Robots_2023\\PinballMachine\\Software\\logs\\cfg_plans.json"
+
+def plan_bytes(cmds):
+    ''' Returns the canonical byte plan for a list of commands.'''
+    out = bytearray()
+    for cmd in cmds:
+        out.append(len(cmd) & 0x00FF)
+        out.extend(v & 0x00FF for v in cmd)
+    return bytes(out)
+
+def plan_hash(cmds):
+    ''' Returns the 16 bit hash of a list of commands.  Never zero.'''
+    h = binascii.crc_hqx(plan_bytes(cmds), 0xFFFF)
+    if h == 0: h = 1
+    return h
+
+def changed_cmds(old, new):
+    ''' Given the plan a node holds (old) and the one wanted (new), returns the
+    indexes of the commands in new that must be sent, in order.  A command can
+    undo part of an earlier one (DEBOUNCE, then DB_BANK for a few switches), so
+    everything from the first command that changed on is sent, so that the node
+    ends up as if it had taken the whole plan.  If the plans don't line up 
+    (different lengths), everything is sent.'''
+    if old is None or len(old) != len(new): return list(range(len(new)))
+    for i, cmd in enumerate(new):
+        if list(old[i]) != list(cmd): return list(range(i, len(new)))
+    return []
+
+def load_plans():
+    ''' Returns the saved plans, as a map of node address to list of commands.
+    Empty if there aren't any, or the file can't be read.'''
+    try:
+        f = open(plan_file_path, "r")
+        plans = json.load(f)
+        f.close()
+        return {int(addr): plans[addr] for addr in plans}
+    except Exception:
+        return {}
+
+def save_plans(plans):
+    ''' Saves the plans given to the nodes.  Returns true if it worked.'''
+    try:
+        f = open(plan_file_path, "w")
+        json.dump({str(addr): plans[addr] for addr in plans}, f)
+        f.close()
+        return True
+    except Exception:
+        return False
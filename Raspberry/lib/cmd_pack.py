@@ -0,0 +1,109 @@
+#  cmd_pack.py -- Packs several node commands into one bus frame
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  A frame carries at most 15 bytes of payload, and each frame pays for
+#  the gap between messages, so it pays to put as many queued commands
+#  into one frame as will fit.  Two forms are used:
+#
+#  PACKED (120)     Container for any node.  Args: a series of (len, cmd bytes...)
+#                   Each sub-command is executed in order, as if sent alone.
+#  NEO_GROUP (108)  Light nodes only.  Same as NEO_SINGLE, but for a list of
+#                   pixels.  Args: C1(3), C2(3), Wait1(1), Wait2(1), Index(1 to 6)
+#
+#  Both are up in the range no node uses for its own commands, so unpack()
+#  can't mistake a plain command (FLIPPER_CTRL is 11) for one of them.  No
+#  node firmware understands them yet, so packed_cmd_nodes and neo_group_nodes
+#  in config.py must stay empty until it does.
+#
+#  Any of these can also go out inside a sequence wrapper, so that a retry
+#  after a lost reply can't run the command twice:
+#
+#  SEQ (121)        Args: seq (1-255), then the command bytes.  Handled in the
+#                   comm_bus library on the node.  If seq is the same as the 
+#                   last one taken, the command is not run again, and the frame
+#                   counts as a plain poll.  The reply to a SEQ frame carries 
+#                   the last seq taken in place of the echo register.
+#
+#  A node keeps its last seq when the Pi restarts, so the Pi can't know
+#  which seq is safe to start with.  It sends a SEQ with no command first
+#  (see sync_seq): that runs nothing, but leaves the node's last seq at one
+#  the Pi knows.
+
+CMD_PACKED = 120
+CMD_NEO_GROUP = 108
+CMD_NEO_SINGLE = 2
+CMD_SEQ = 121
+
+MAX_PAYLOAD = 15
+MAX_GROUP_PIXELS = MAX_PAYLOAD - 9
+SEQ_OVERHEAD = 2
+
+def _neo_group_key(cmd):
+    # Everything in a NEO_SINGLE except the pixel index.
+    if len(cmd) != 10 or cmd[0] != CMD_NEO_SINGLE: return None
+    return (cmd[1], cmd[2], cmd[3], cmd[4], cmd[5], cmd[6], cmd[8], cmd[9])
+
+def pack(cmds, neo_group=False, max_payload=MAX_PAYLOAD):
+    ''' Packs commands from the front of cmds (a list of command byte lists, in
+    the order they are to be sent) into one frame payload of at most max_payload
+    bytes.  Returns a tuple of the payload and the number of commands it holds.
+    When only one command fits, it is returned unchanged.'''
+    if len(cmds) == 0: return None, 0
+    first = cmds[0]
+    if neo_group:
+        key = _neo_group_key(first)
+        if key is not None:
+            n = 1
+            while n < len(cmds) and n < max_payload - 9 and _neo_group_key(cmds[n]) == key: n += 1
+            if n > 1:
+                r1, g1, b1, r2, g2, b2, w1, w2 = key
+                dat = [CMD_NEO_GROUP, r1, g1, b1, r2, g2, b2, w1, w2]
+                for i in range(n): dat.append(cmds[i][7])
+                return dat, n
+    nbytes = 1
+    n = 0
+    while n < len(cmds) and nbytes + len(cmds[n]) + 1 <= max_payload:
+        nbytes += len(cmds[n]) + 1
+        n += 1
+    if n <= 1: return first, 1
+    dat = [CMD_PACKED]
+    for i in range(n):
+        dat.append(len(cmds[i]))
+        dat.extend(cmds[i])
+    return dat, n
+
+def next_seq(seq):
+    ''' Returns the sequence number to use after seq.  Zero is never used, since
+    that is what a node starts out with.'''
+    return seq % 255 + 1
+
+def sync_seq(seq):
+    ''' Returns a SEQ frame with no command, that sets the node's last seq.'''
+    return [CMD_SEQ, seq]
+
+def wrap_seq(seq, dat):
+    ''' Returns dat inside a SEQ wrapper, or None if it won't fit in a frame.'''
+    if len(dat) + SEQ_OVERHEAD > MAX_PAYLOAD: return None
+    return [CMD_SEQ, seq] + list(dat)
+
+def unpack(dat):
+    ''' Reference unpacker, as the node firmware should do it.  Returns a list
+    of the plain commands held in the payload.  Raises ValueError if a
+    container is malformed.'''
+    if len(dat) == 0: return []
+    if dat[0] == CMD_PACKED:
+        cmds = []
+        i = 1
+        while i < len(dat):
+            n = dat[i]
+            if n == 0 or i + 1 + n > len(dat): raise ValueError("Bad sub-command length in packed command.")
+            cmds.append(list(dat[i + 1:i + 1 + n]))
+            i += n + 1
+        return cmds
+    if dat[0] == CMD_NEO_GROUP:
+        if len(dat) < 10: raise ValueError("No pixels in NEO_GROUP command.")
+        cmds = []
+        for ipx in dat[9:]:
+            cmds.append([CMD_NEO_SINGLE, dat[1], dat[2], dat[3], dat[4], dat[5], dat[6], ipx, dat[7], dat[8]])
+        return cmds
+    return [list(dat)]
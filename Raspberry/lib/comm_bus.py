@@ -6,33 +6,344 @@
 #  nodes.
 
 import serial
+import serial.rs485
+import sys
 import time
-import RPi.GPIO as gpio
+import select
+import fcntl
+import termios
+import collections
+import array
+import random
+try:
+    import RPi.GPIO as gpio
+except ImportError:
+    gpio = None     # Not on the Pi.  Only buses without a tx enable pin can be used.
 from pb_log import log, logd
+import bus_frames
+import bus_stats
+import bus_speed
 
+_default_port = "/dev/ttyAMA0"
 _tx_enable_pin = 12  # This is pin 12 on the header, labeld as GPIO18
 
+# Ways to decide when our message is out on the wire, so the
+# transmitter can be turned off:
+TX_SLEEP = "sleep"   # Sleep for the calculated wire time (the old way)
+TX_DRAIN = "drain"   # Poll the kernel until the UART shift register is empty
+TX_RS485 = "rs485"   # Let the kernel drive RTS as the transmit enable
+tx_modes = (TX_SLEEP, TX_DRAIN, TX_RS485)
+
+# Ways to wait for the reply:
+RX_SPIN = "spin"     # Read the port over and over (the old way, uses a whole core)
+RX_SELECT = "select" # Sleep in select() until bytes arrive
+rx_modes = (RX_SPIN, RX_SELECT)
+
+# Linux ioctls for watching the transmitter drain.
+_TIOCSERGETLSR = 0x5459
+_TIOCSER_TEMT = 0x01
+
+# Linux ioctls for the low latency flag.  The flags are the fifth int in
+# struct serial_struct.
+_TIOCGSERIAL = 0x541E
+_TIOCSSERIAL = 0x541F
+_ASYNC_LOW_LATENCY = 1 << 13
+
 class CommBus():
-    ''' Manages comm bus for all nodes in pinball machine. '''
-    def __init__(self):
+    ''' Manages one comm bus segment, and the nodes on it.  The port is the serial
+    device, and tx_enable_pin the header pin that drives the RS-485 transmit 
+    enable.  Use None for the pin if there isn't one (RS-485 auto direction,
+    or a pty stand-in from node_emulator.py).'''
+    def __init__(self, port=_default_port, tx_enable_pin=_tx_enable_pin):
+        self._port = port
+        self._tx_pin = tx_enable_pin
         self._ser = None
         self._txon = False
         self._tm_last_msg = time.monotonic() - 1.0
         self._logging = False       # Turn off most common log outputs
+        self._codec = bus_frames.FrameCodec()
+        self._parser = bus_frames.FrameParser(self._codec)
+        self._tx_mode = TX_SLEEP
+        self._rx_mode = RX_SPIN
+        self._tuning = False        # If the low latency settings are applied at begin()
+        self._baud = bus_speed.BASE_RATE
+        self._bad_rates = set()     # Rates that didn't work out, and won't be tried again
+        self._fallback_errs = 10    # Bad cycles in the window that send us back to the base rate
+        self._rate_errs = collections.deque(maxlen=200)  # For each recent cycle, if it went bad
+        self._tm_settled = 0.0      # After a fall back, the bus is left alone until then
+        self._use_lsr = True        # If the driver supports TIOCSERGETLSR
+        self._ioctl_buf = bytearray(4)
+        self._tx_times = collections.deque(maxlen=500)  # TX turnaround for recent cycles, in usecs
+        self._tm_bus_idle = self._tm_last_msg  # When the bus last went quiet
+        self._tm_tx_start = self._tm_last_msg  # When the last node cycle started to send
+        self._last_cycle_failed = True
+        self._gap_min = 0.001       # Shortest quiet time allowed before a message (secs)
+        self._gap_max = 0.010       # Quiet time used for unknown nodes and after errors (secs)
+        self._adaptive_gap = False  # If false, the old fixed 10ms spacing is used
+        self._gaps = {}             # Learned gap for each node
+        self._gap_floors = {}       # Least gap for each node, whatever is learned
+        self._bus_nodes = []        # Every node on the bus, if known
+        self._latencies = {}        # Smoothed time for each node to start its reply
+        self._stats_window = 500    # Number of cycles kept for the timing stats of each node
+        self._node_stats = {}       # Timing stats, by node
         self.clear_counts()
 
     def clear_counts(self):
         self._bus_cycles = 0        # Total number of bus IO operations attempted
         self._no_response_errs = 0  # Number of non-responsive queries
-        self._checksum_errs = 0     # Number of rejected msg due to checksum mismatch
         self._write_errs = 0        # Errors during writing to bus (serious, should not happen)
-        self._protocol_errs = 0     # Errors due to bad fist byte
+        self._broadcasts = 0        # Broadcast frames sent
+        self._parser.clear_counts() # Receive errors, by class
+        self._tx_times.clear()
+        self._node_cycles = {}      # Bus cycles, by node
+        for st in self._node_stats.values(): st.clear()
+        self._tm_counts_cleared = time.monotonic()
+
+    def set_stats_window(self, n):
+        ''' Sets how many of the most recent cycles the per-node stats are taken over.'''
+        self._stats_window = n
+        self._node_stats = {}
+
+    def _stats_for(self, addr):
+        st = self._node_stats.get(addr)
+        if st is None:
+            st = bus_stats.NodeBusStats(self._stats_window)
+            self._node_stats[addr] = st
+        return st
+
+    def set_tx_mode(self, mode):
+        ''' Sets how the end of a transmit is detected.  Should be one of
+        TX_SLEEP, TX_DRAIN or TX_RS485.  Call before begin().  TX_RS485 needs
+        the driver enable wired to the UART's RTS line.'''
+        if mode not in tx_modes:
+            log(f"Unknown comm bus tx mode ({mode}).  Using {TX_SLEEP}.")
+            mode = TX_SLEEP
+        self._tx_mode = mode
+
+    def set_rx_mode(self, mode):
+        ''' Sets how we wait for replies.  Should be RX_SPIN or RX_SELECT.'''
+        if mode not in rx_modes:
+            log(f"Unknown comm bus rx mode ({mode}).  Using {RX_SPIN}.")
+            mode = RX_SPIN
+        self._rx_mode = mode
+
+    def set_tuning(self, enable):
+        ''' If enabled, begin() locks the port for our use only, and sets it up
+        to hand us bytes as soon as they arrive.  Call before begin().'''
+        self._tuning = enable
+
+    def set_fallback(self, nerrs, ncycles):
+        ''' When running above the base rate, fall back to it if nerrs of the last
+        ncycles cycles fail or see a checksum error.'''
+        self._fallback_errs = nerrs
+        self._rate_errs = collections.deque(maxlen=ncycles)
+
+    def baud(self):
+        return self._baud
+
+    def _set_baud(self, rate):
+        self._baud = rate
+        if self._ser is not None: self._ser.baudrate = rate
+        self._rate_errs.clear()
+        # Let everyone settle with a long quiet period.
+        self._last_cycle_failed = True
+        self._tm_bus_idle = time.monotonic()
+
+    def negotiate(self, addrs, allowed):
+        ''' Moves the bus to the fastest rate that all the given nodes can do, 
+        out of the allowed list.  The new rate is checked with echos, and if 
+        anything goes wrong, the whole bus goes back to the base rate.  Every node
+        on the segment must be listed.  Returns the rate in use afterwards.'''
+        masks = []
+        for addr in addrs:
+            # A node's reply is loaded before it runs the frame's command, so
+            # the rate mask comes back in the reply to the second GET_RATES.
+            for i in range(2):
+                rsp = self.node_io(addr, [bus_speed.CMD_GET_RATES])
+                if rsp is None or len(rsp) < 3:
+                    log(f"Node {addr} did not give its bus rates.  Staying at {self._baud} baud on {self._port}.")
+                    return self._baud
+            masks.append(rsp[2])
+        rate = bus_speed.best_common_rate(masks, [r for r in allowed if r not in self._bad_rates])
+        if rate == self._baud: return rate
+        code = bus_speed.rate_code(rate)
+        for addr in addrs:
+            if self.node_io(addr, [bus_speed.CMD_SET_RATE, code]) is None:
+                self._fall_back(rate, f"node {addr} did not take SET_RATE")
+                self._wait_settled()
+                return self._baud
+        self._set_baud(rate)
+        for addr in addrs:
+            # Each reply carries the value sent in the frame before it.
+            last = None
+            for i in range(4):
+                val = random.randint(0, 255)
+                rsp = self.node_io(addr, [bus_speed.CMD_ECHO, val])
+                if rsp is None or len(rsp) < 3 or (last is not None and rsp[2] != last):
+                    self._fall_back(rate, f"echo check failed on node {addr}")
+                    self._wait_settled()
+                    return self._baud
+                last = val
+        log(f"Comm bus on {self._port} now at {rate} baud.")
+        return rate
+
+    def _fall_back(self, rate, why):
+        ''' Goes back to the base rate.  The nodes do the same on their own once
+        the bus has been quiet for REVERT_TIME, so nothing is sent until then.
+        This doesn't wait: callers check settling(), and skip the bus meanwhile.'''
+        log(f"Comm bus on {self._port} falling back to {bus_speed.BASE_RATE} baud from {rate}: {why}")
+        self._bad_rates.add(rate)
+        self._set_baud(bus_speed.BASE_RATE)
+        self._tm_settled = time.monotonic() + bus_speed.REVERT_TIME + 0.1
+
+    def settling(self):
+        ''' Returns true while the nodes are going back to the base rate, after 
+        a fall back.  Nothing goes out on the bus until that's done.'''
+        return time.monotonic() < self._tm_settled
+
+    def _wait_settled(self):
+        # Only for startup, where there is no game loop to hold up.
+        twait = self._tm_settled - time.monotonic()
+        if twait > 0.0: time.sleep(twait)
+
+    def _watch_rate(self, bad):
+        self._rate_errs.append(bad)
+        if sum(self._rate_errs) >= self._fallback_errs:
+            self._fall_back(self._baud, f"{self._fallback_errs} bad cycles out of the last {len(self._rate_errs)}")
+
+    def set_gaps(self, gap_min, gap_max, adaptive=True, floors=None):
+        ''' Sets the quiet time on the bus before each message, in seconds.  If
+        adaptive, the gap for each node is learned from its replies, and kept 
+        between gap_min and gap_max.  Otherwise gap_max is always used.  Floors
+        is a map of node address to the least gap that node gets, for nodes
+        whose reply times don't show how long they can be deaf (a light node
+        with interrupts off while it updates its pixels, for instance).'''
+        self._gap_min = gap_min
+        self._gap_max = gap_max 
+        self._adaptive_gap = adaptive
+        self._gap_floors = dict(floors) if floors is not None else {}
+        self._gaps = {}
+        self._latencies = {}
+
+    def set_nodes(self, addrs):
+        ''' Tells the bus which nodes are on it.  Every node hears every frame,
+        so the gap before any frame must suit all of them.'''
+        self._bus_nodes = list(addrs)
+
+    def _node_gap(self, addr):
+        # The gap one node needs.  Unknown nodes get gap_max.
+        return max(self._gaps.get(addr, self._gap_max), self._gap_floors.get(addr, 0.0))
+
+    def _bus_gap(self):
+        # The gap before any frame: enough for the slowest node on the bus.
+        if not self._adaptive_gap or self._last_cycle_failed: return self._gap_max
+        addrs = self._bus_nodes if len(self._bus_nodes) > 0 else list(self._gaps)
+        if len(addrs) == 0: return self._gap_max
+        return max(self._node_gap(a) for a in addrs)
+
+    def _learn_gap(self, addr, turnaround, nreply):
+        ''' Updates what we know about a node after a bus cycle.  Turnaround is the 
+        time from the end of our message to the end of the reply, or None if the
+        node didn't answer.  nreply is the number of bytes in the reply.'''
+        self._node_cycles[addr] = self._node_cycles.get(addr, 0) + 1
+        gap = self._gaps.get(addr, self._gap_max)
+        if turnaround is None:
+            self._stats_for(addr).fails += 1
+            # Something went wrong.  Back off on this node, and let every
+            # node see a long quiet period so they can resync.
+            self._last_cycle_failed = True
+            self._gaps[addr] = min(self._gap_max, gap * 2)
+            return
+        self._last_cycle_failed = False
+        # The time the node took to start answering is a good measure of how
+        # busy its main loop is, and so how long it needs between messages.
+        latency = turnaround - (nreply * 10 / self._baud)
+        if addr in self._latencies: latency = self._latencies[addr] * 0.9 + latency * 0.1
+        self._latencies[addr] = latency
+        gap = max(gap * 0.9, latency, self._gap_min)
+        self._gaps[addr] = min(gap, self._gap_max)
+
+    def port(self):
+        return self._port
 
     def begin(self):
-        gpio.setwarnings(False)
-        gpio.setmode(gpio.BOARD)
-        gpio.setup(_tx_enable_pin, gpio.OUT, initial=gpio.LOW)
-        self._ser = serial.Serial("/dev/ttyAMA0", baudrate=115200, write_timeout=0.060, timeout=0, parity='N', stopbits=1)
+        if self._tx_pin is not None:
+            gpio.setwarnings(False)
+            gpio.setmode(gpio.BOARD)
+            gpio.setup(self._tx_pin, gpio.OUT, initial=gpio.LOW)
+        args = {"baudrate": self._baud, "write_timeout": 0.060, "timeout": 0, "parity": 'N', "stopbits": 1}
+        if self._tuning: args["exclusive"] = True
+        try:
+            self._ser = serial.Serial(self._port, **args)
+        except ValueError as err:
+            # Older pyserial, without the exclusive option.
+            log(f"Unable to lock comm port ({err}).")
+            del args["exclusive"]
+            self._ser = serial.Serial(self._port, **args)
+        if self._tuning: 
+            applied = self._apply_tuning(True)
+            if "exclusive" in args: applied.append("exclusive lock")
+            log(f"Comm port tuning on {self._port}: {', '.join(applied)}")
+        if self._tx_mode == TX_RS485:
+            try:
+                self._ser.rs485_mode = serial.rs485.RS485Settings(rts_level_for_tx=True, rts_level_for_rx=False)
+            except Exception as err:
+                log(f"Unable to put serial port in RS-485 mode ({err}).  Using {TX_DRAIN}.")
+                self._tx_mode = TX_DRAIN
+        log(f"Comm bus on {self._port}: tx mode = {self._tx_mode}, rx mode = {self._rx_mode}")
+
+    def _apply_tuning(self, enable):
+        ''' Turns the low latency settings on or off.  Returns a list of what 
+        was done, for the log.'''
+        fd = self._ser.fileno()
+        applied = []
+        # Raw mode, and reads that return at once with whatever is there.  Pyserial
+        # should have done this already, but make sure.
+        try:
+            attrs = termios.tcgetattr(fd)
+            attrs[0] &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR |
+                          termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY)
+            attrs[1] &= ~termios.OPOST
+            attrs[3] &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+            attrs[6][termios.VMIN] = 0
+            attrs[6][termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            applied.append("raw VMIN=0 VTIME=0")
+        except termios.error as err:
+            applied.append(f"raw mode failed ({err})")
+        # The low latency flag stops the driver from holding received bytes
+        # back for a tick before passing them up.
+        try:
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(fd, _TIOCGSERIAL, buf)
+            if enable: buf[4] |= _ASYNC_LOW_LATENCY
+            else: buf[4] &= ~_ASYNC_LOW_LATENCY
+            fcntl.ioctl(fd, _TIOCSSERIAL, buf)
+            applied.append(f"low_latency={'on' if enable else 'off'}")
+        except OSError as err:
+            applied.append(f"low_latency not supported ({err.strerror})")
+        # The PL011 receive FIFO trigger level is fixed by the driver, and can't be
+        # changed from here.  The driver's receive timeout covers short replies.
+        return applied
+
+    def calibrate(self, addr, ncycles=100):
+        ''' Measures the reply time of a node with the low latency settings off,
+        and then on.  Logs and returns both medians, in usecs.  The settings are 
+        left as they were set up by begin().  The node must be active.'''
+        results = []
+        for enable in (False, True):
+            self._apply_tuning(enable)
+            times = []
+            for i in range(ncycles):
+                t0 = self.t_us()
+                rsp = self.node_io(addr, [100, i & 0x00FF])
+                if rsp is not None: times.append(self.t_us() - t0)
+            times.sort()
+            if len(times) == 0: results.append(None)
+            else: results.append(times[len(times) // 2])
+        self._apply_tuning(self._tuning)
+        log(f"Comm port calibration on node {addr}: reply time untuned = {results[0]}us, tuned = {results[1]}us")
+        return tuple(results)
 
     def enable_logging(self):
         self._logging = True
@@ -45,25 +356,96 @@ class CommBus():
         rp = {} 
         rp["Bus Cycles"] = self._bus_cycles
         rp["Response Errors"] = self._no_response_errs
-        rp["Checksum Errors"] = self._checksum_errs
         rp["Write Errors"] = self._write_errs
-        rp["Protocall Errors"] = self._protocol_errs
+        rp["Broadcasts"] = self._broadcasts
+        rp["Checksum Errors"] = self._parser.checksum_errs
+        rp["Sync Errors"] = self._parser.sync_errs
+        rp["Address Errors"] = self._parser.addr_errs
+        rp["Echo Frames"] = self._parser.echo_frames
+        rp["Recovered Replies"] = self._parser.recovered
+        rp["TX Mode"] = self._tx_mode
+        rp["RX Mode"] = self._rx_mode
+        rp["Baud"] = self._baud
+        # What the bus waits before each frame: the most any node on it needs.
+        rp["Bus Gap (ms)"] = f"{self._bus_gap() * 1000:.2f}"
+        n = len(self._tx_times)
+        if n > 0:
+            rp["TX Turnaround Avg (us)"] = int(sum(self._tx_times) / n)
+            rp["TX Turnaround Max (us)"] = max(self._tx_times)
+        telp = time.monotonic() - self._tm_counts_cleared
+        for addr in sorted(self._node_cycles):
+            gap = self._node_gap(addr) * 1000
+            latency = self._latencies.get(addr, 0) * 1000
+            rate = self._node_cycles[addr] / telp
+            rp[f"Node {addr}"] = f"node_gap={gap:.2f}ms latency={latency:.2f}ms rate={rate:.1f}/s " + self._stats_for(addr).report()
         return rp
 
+    def snapshot(self):
+        ''' Returns the bus stats as plain data, for tools and tuning.  Times 
+        are in usecs, and each timing is summarized over the last few hundred 
+        cycles with that node (see bus_stats.py).'''
+        snap = {} 
+        snap["bus_cycles"] = self._bus_cycles
+        snap["response_errs"] = self._no_response_errs
+        snap["write_errs"] = self._write_errs
+        snap["checksum_errs"] = self._parser.checksum_errs
+        snap["sync_errs"] = self._parser.sync_errs
+        snap["addr_errs"] = self._parser.addr_errs
+        snap["recovered"] = self._parser.recovered
+        snap["broadcasts"] = self._broadcasts
+        snap["port"] = self._port
+        snap["tx_mode"] = self._tx_mode
+        snap["rx_mode"] = self._rx_mode
+        snap["baud"] = self._baud
+        snap["gap_us"] = int(self._bus_gap() * 1.0e6)   # Used before every frame
+        snap["secs"] = time.monotonic() - self._tm_counts_cleared
+        snap["nodes"] = {}
+        for addr in sorted(self._node_stats):
+            ns = self._node_stats[addr].snapshot()
+            ns["cycles"] = self._node_cycles.get(addr, 0)
+            ns["gap_us"] = int(self._node_gap(addr) * 1.0e6)   # What this node alone needs
+            snap["nodes"][addr] = ns
+        return snap
+
     def _enable_tx(self):
-        gpio.output(_tx_enable_pin, gpio.HIGH)
+        if self._tx_mode == TX_RS485 or self._tx_pin is None: return
+        gpio.output(self._tx_pin, gpio.HIGH)
 
     def _disable_tx(self):
-        gpio.output(_tx_enable_pin, gpio.LOW)
+        if self._tx_mode == TX_RS485 or self._tx_pin is None: return
+        gpio.output(self._tx_pin, gpio.LOW)
+
+    def _wait_tx_sleep(self, nbytes):
+        # self.ser.flush()  # This should have worked, but
+        # flush takes way too long, over 27 ms!
+        # So, here we do a kludge...  Cal time it should have
+        # taken, add about .25ms, and wait.
+        twait = (nbytes * 10 / self._baud) + 0.0001
+        time.sleep(twait)
 
-    def _checksum(self, msg, nmsg):
-        sum = 0
-        for i, v in enumerate(msg):
-            if i >= nmsg: 
-                break
-            sum += v
-        sum = sum & 0x00FF
-        return sum
+    def _wait_tx_drain(self, nbytes):
+        ''' Spins until the kernel says the last bit is out of the UART. If the
+        driver can't tell us about the shift register, wait for the output 
+        queue to empty and add one character time.  Gives up after twice the
+        expected time.'''
+        tlimit = time.monotonic() + (nbytes * 20 / self._baud) + 0.001
+        fd = self._ser.fileno()
+        buf = self._ioctl_buf
+        if self._use_lsr:
+            try:
+                while True:
+                    fcntl.ioctl(fd, _TIOCSERGETLSR, buf, True)
+                    if buf[0] & _TIOCSER_TEMT: return
+                    if time.monotonic() > tlimit: return
+            except OSError:
+                log("TIOCSERGETLSR not supported on comm port.  Watching output queue instead.")
+                self._use_lsr = False
+        while True:
+            fcntl.ioctl(fd, termios.TIOCOUTQ, buf, True)
+            if int.from_bytes(buf, sys.byteorder) == 0: break
+            if time.monotonic() > tlimit: return
+        tend = time.monotonic() + 10 / self._baud
+        while time.monotonic() < tend: pass
 
     def close(self):
         ''' Shuts down the Serial port.  Must use begin() to restart
@@ -84,38 +466,91 @@ class CommBus():
     def t_us(self):
         return int(time.monotonic_ns() / 1000)
 
+    def _wait_for_gap(self, gap):
+        # If the bus hasn't been quiet long enough, delay here.
+        tnow = time.monotonic()
+        if self._adaptive_gap: elp = tnow - self._tm_bus_idle
+        else: elp = tnow - self._tm_last_msg
+        if elp < gap: time.sleep(gap - elp)
+
+    def broadcast(self, data):
+        ''' Sends data to every node at once.  No node answers, so there is no
+        way to know from here that the nodes got it -- poll them afterwards if that
+        matters.  Uses one bus slot, instead of one cycle per node.  Returns True
+        if the frame went out.'''
+        if self.settling(): return False
+        out_bytes = self._codec.encode(bus_frames.BROADCAST_ADDR, data)
+        nmsg = len(out_bytes)
+        self._wait_for_gap(self._bus_gap())
+        self._broadcasts += 1
+        try:
+            self._enable_tx() 
+            nw = self._ser.write(out_bytes)
+            if self._tx_mode == TX_SLEEP: self._wait_tx_sleep(nmsg)
+            elif self._tx_mode == TX_DRAIN: self._wait_tx_drain(nmsg)
+        except Exception as err:
+            log(f'Serious error with com port. Write fail on broadcast.')
+            log(f'Error {type(err)}: {str(err)}')
+            self._disable_tx()
+            self._write_errs += 1
+            return False
+        self._disable_tx()
+        self._tm_last_msg = self._tm_bus_idle = time.monotonic()
+        if nw != nmsg:
+            log(f'Broadcast write fail.  Tried to send {nmsg} bytes, but {nw} bytes reported.')
+            self._write_errs += 1
+            return False
+        return True
+
     def node_io(self, addr, data=None):
         ''' Executes an IO cycle on the given node, with the given data.
         The data should not be more than 15 bytes.  The data can be None.
-        It returns a bytearray of the received data (not the entire msg),
-        or None on error. This call can block for up to about 10 ms.'''
+        It returns a memoryview of the received data (not the entire msg),
+        or None on error.  The returned data is only good until the next
+        call on the same node.  This call can block for up to about 10 ms.
+        Returns None at once while the bus is settling().'''
+        if self.settling(): return None
+        tcpu = time.thread_time()
+        nerrs = self._parser.checksum_errs
+        rsp = self._node_io(addr, data)
+        self._stats_for(addr).cpu.add(int((time.thread_time() - tcpu) * 1.0e6))
+        if self._baud != bus_speed.BASE_RATE: 
+            self._watch_rate(rsp is None or self._parser.checksum_errs != nerrs)
+        return rsp
+
+    def tx_start_time(self):
+        ''' Returns when (monotonic time) the last node cycle started to send.  A
+        node's reply is loaded just before our frame gets to it, so this is the
+        time the reply describes.'''
+        return self._tm_tx_start
+
+    def _wait_rx(self, tleft):
+        ''' Sleeps until there are bytes to read, or tleft secs go by.  Once a
+        frame has started, also sleeps through the bytes that must still be on 
+        the wire, so we wake up about once per frame instead of once per byte.'''
+        r, _, _ = select.select([self._ser.fileno()], [], [], tleft)
+        if len(r) == 0: return
+        nneed = self._parser.bytes_needed() - self._ser.in_waiting
+        # Leave the last byte to arrive while we are awake, so as not to add
+        # the sleep overshoot to the reply time.
+        twait = (nneed - 1) * 10 / self._baud
+        if twait > 0.0002: time.sleep(min(twait, tleft))
+
+    def _node_io(self, addr, data):
 
         # First, prepare the out-going message...
-        if data is None: data = bytearray(0)
-        ndat = len(data)
-        if ndat > 15: raise ValueError
-        nmsg = ndat + 3
-        out_bytes = bytearray(nmsg)
-        out_bytes[0] = ord('E')
-        out_bytes[1] = (addr << 4 | ndat) & 0x00FF
-        for i, v in enumerate(data):
-            if i > 15: break
-            out_bytes[i + 2] = v & 0x00FF
-        cksum = self._checksum(out_bytes, nmsg - 1)
-        out_bytes[nmsg - 1] = cksum
-
-        # If not enough time has elapsed since our last msg,
+        out_bytes = self._codec.encode(addr, data)
+        nmsg = len(out_bytes)
+
+        # If the bus hasn't been quiet long enough for every node,
         # delay here.
-        tnow = time.monotonic()
-        elp = tnow - self._tm_last_msg
-        if elp < 0.010:
-            twait = 0.010 - elp
-            time.sleep(twait)
+        self._wait_for_gap(self._bus_gap())
         
         # Now, clear out any crud on the receive line.
         self._ser.reset_input_buffer()
 
         trecord = []
+        self._tm_tx_start = time.monotonic()
         tr0 = self.t_us()
         self._bus_cycles += 1
         # Send the message.  Do this by first enabling the transmitter.
@@ -125,12 +560,8 @@ class CommBus():
             self._txon = True 
             nw = self._ser.write(out_bytes)  # does not block!
             trecord.append(self.t_us() - tr0)
-            # self.ser.flush()  # This should have worked, but
-            # flush takes way too long, over 27 ms!
-            # So, here we do a kludge...  Cal time it should have
-            # taken, add about .25ms, and wait.
-            twait = (len(out_bytes) * 10 / 115200.0) + 0.0001
-            time.sleep(twait)
+            if self._tx_mode == TX_SLEEP: self._wait_tx_sleep(nmsg)
+            elif self._tx_mode == TX_DRAIN: self._wait_tx_drain(nmsg)
             trecord.append(self.t_us() - tr0)
         except Exception as err:
             # This is probably some sort of write timeout.  It
@@ -139,15 +570,19 @@ class CommBus():
             log(f'Error {type(err)}: {str(err)}')
             self._disable_tx()
             self._write_errs += 1
+            self._learn_gap(addr, None, 0)
             return None
         trecord.append(self.t_us() - tr0)
         self._disable_tx()
         trecord.append(self.t_us() - tr0)
+        self._tx_times.append(trecord[-1])
+        ttx = trecord[-1]
         logd(f'times = {trecord}')
         if nw != nmsg:
             log("Serious error with com port. Write fail.")
             log(f'All bytes not written.  Tried to send {nmsg} bytes, but {nw} bytes reported.')
             self._write_errs += 1
+            self._learn_gap(addr, None, 0)
             return None
 
         # Go into receive mode.  When real RS-485 is used, we should see two
@@ -157,9 +592,7 @@ class CommBus():
         # If this takes more than 10ms, something is wrong.
         tsent = time.monotonic()  # the time we delivered the command message
         self._tm_last_msg = tsent
-        imsgptr = 0  # the location in the current message
-        datlen = 0   # the indicated message len
-        in_msgbuf = bytearray(60)  # the accumulated input
+        self._parser.reset(addr)
         ncnt = 0;
         while(True):
             ncnt += 1
@@ -167,61 +600,31 @@ class CommBus():
             if tnow - tsent > 0.01:
                 # No response.  
                 if self._logging: log(f'No response from slave node. Node={addr}  {ncnt}' )
+                if self._logging and self._parser.last_error != "": log(f'Last receive error: {self._parser.last_error}')
                 self._no_response_errs += 1
+                self._tm_bus_idle = tnow
+                self._learn_gap(addr, None, 0)
                 return None
             # We set the mode to not-blocking!  We might not get anything back
             # on the read, but stay in this loop till the slave node has had
             # every chance to respond.
+            if self._rx_mode == RX_SELECT: self._wait_rx(0.01 - (tnow - tsent))
             buf = self._ser.read(50)
             if len(buf) <= 0:
                 if self._logging: logd(f'No bytes on serial port. {ncnt}')
             if len(buf) > 0:
                 if self._logging: logd(f'{len(buf)} bytes read on serial port. {ncnt}')
                 if self._logging: logd("Bytes = " + self._bytes_to_str(buf))
-                # process the input bytes here.
-                for c in buf:
-                    if imsgptr == 0: 
-                        # process the sync byte
-                        if c != ord('e') and c != ord('E'):
-                            if self._logging: log(f"Message protocol fail.  Illegal first byte ({c})")
-                            self._protocol_errs += 1
-                            return None
-                        in_msgbuf[0] = c
-                        imsgptr = 1
-                        continue
-                    if imsgptr == 1:
-                        # process the address/len byte
-                        in_msgbuf[1] = c
-                        addr_temp = (c >> 4) & 0x000F
-                        datlen = c & 0x000F
-                        if addr_temp != addr:
-                            if self._logging: log(f"Message fail. Returned address from slave incorrect. ({addr} != {addr_temp}).")
-                            self._protocol_errs += 1
-                            return
-                        imsgptr = 2
-                        continue
-                    if (imsgptr  >= datlen + 2):
-                            # this should be the check sum byte.
-                            cksum = self._checksum(in_msgbuf, imsgptr)
-                            if c != cksum:
-                                if self._logging: log(f"Checksum fail on receive. Found {c}. Should be {cksum}.")
-                                if self._logging: log(f"Message payload size = {datlen}")
-                                if self._logging: log(f"Bytes in msg = {self._bytes_to_str(in_msgbuf)}")
-                                self._checksum_errs += 1
-                                return None
-                            # We have a completed message... check if it is an Echo or really from
-                            # the slave node.
-                            if in_msgbuf[0] == ord('E'):
-                                # it was just an echo.  Need to get the next msg.
-                                imsgptr = 0
-                                continue
-                            # This is success!
-                            payload = []
-                            for c in in_msgbuf[2:imsgptr]: payload.append(c)
-                            return payload
-                    in_msgbuf[imsgptr] = c 
-                    imsgptr += 1
-                    continue
+                # The parser skips garbage and our own echo, and hands back 
+                # the node's payload once it is complete.
+                payload = self._parser.feed(buf)
+                if payload is not None: 
+                    self._tm_bus_idle = time.monotonic()
+                    short = None
+                    if nmsg == 4 and out_bytes[2] == bus_frames.CMD_POLL_DELTA: short = len(payload) <= 3
+                    self._stats_for(addr).add(ttx, self.t_us() - tr0 - ttx, nmsg + len(payload) + 3, short)
+                    self._learn_gap(addr, self._tm_bus_idle - tsent, len(payload) + 3)
+                    return payload
 
     # def _checksum(self, msg, nmsg):
     #     sum = 0
@@ -0,0 +1,34 @@
+#  debounce.py -- Debounce setup for the lane and target nodes
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Those nodes take two debounce commands:
+#    DEBOUNCE (30)  Args: tunit_low, tunit_high.  Sets every switch.
+#    DB_BANK  (31)  Args: bank, mask, tunit_low, tunit_high.  Sets the
+#                   switches in the mask, in bank 0 (switches 1-8) or
+#                   bank 1 (switches 9-15).
+#  Most switches have the same settings, so rather than a command per
+#  switch, the most common setting goes to all of them with DEBOUNCE, and
+#  the rest are grouped into one DB_BANK per bank and setting.
+
+CMD_DEBOUNCE = 30
+CMD_DB_BANK = 31
+
+def debounce_cmds(settings):
+    ''' Given a list of (t_low, t_high) for each switch, starting with switch 1,
+    returns a list of (cmd, name) that sets them all, in the order to send them.'''
+    if len(settings) == 0: return []
+    counts = {}
+    for st in settings: counts[st] = counts.get(st, 0) + 1
+    common = max(counts, key=lambda st: counts[st])
+    cmds = [([CMD_DEBOUNCE, common[0], common[1]], f"debounce for all switches tlow={common[0]}, thigh={common[1]}")]
+    groups = {}   # (bank, t_low, t_high) -> [mask, switch numbers]
+    for i, st in enumerate(settings):
+        if st == common: continue
+        bank, bit = divmod(i, 8)
+        grp = groups.setdefault((bank, st[0], st[1]), [0, []])
+        grp[0] |= 1 << bit
+        grp[1].append(str(i + 1))
+    for (bank, t_low, t_high), (mask, sws) in groups.items():
+        name = f"debounce for switches {','.join(sws)} tlow={t_low}, thigh={t_high}"
+        cmds.append(([CMD_DB_BANK, bank, mask, t_low, t_high], name))
+    return cmds
@@ -0,0 +1,60 @@
+#  hw_events.py -- Event codes for hardware events, and dispatch tables
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Every switch on the machine has a small integer code.  Each node's
+#  designator gets a block of 16 codes, so a code is base + switch index.
+#  The codes are members of the IntEnum Ev (Ev.T3, Ev.L10, ...), whose
+#  names are used when events are logged.
+#
+#  Subscribers give a dispatch table: a map of event code to handler.  An
+#  EventDispatcher merges them into one list per code, so each event goes
+#  only to the handlers that asked for it, with one list index to find
+#  them.  A handler is called with the event, and can return True to stop
+#  the rest of the batch from being dispatched.
+
+import enum
+
+# Designator -> (first code, number of switches)
+blocks = {'F': (0x00, 8), 'B': (0x10, 3), 'K': (0x20, 3), 'L': (0x30, 11), 'T': (0x40, 8)}
+
+NCODES = 0x50
+
+Ev = enum.IntEnum("Ev", [(f"{d}{i+1}", base + i) for d, (base, n) in blocks.items() for i in range(n)])
+
+_by_name = {ev.name: ev for ev in Ev}
+
+# Name of each code, for logging.  Empty for unused codes.
+names = [""] * NCODES
+for ev in Ev: names[ev] = ev.name
+
+def event_code(designator, isw):
+    ''' Returns the code for switch isw (starting at zero) on the node with the
+    given designator.'''
+    return Ev(blocks[designator][0] + isw)
+
+def code_for_name(name):
+    ''' Returns the code for an event name such as "T3", or None if there isn't one.'''
+    return _by_name.get(name)
+
+class EventDispatcher():
+    def __init__(self):
+        self._table = [[] for _ in range(NCODES)]
+
+    def register(self, table):
+        ''' Adds a subscriber's dispatch table: a map of event code (or tuple of
+        codes) to handler.  Handlers for the same code are called in the order
+        they were registered.'''
+        for key, handler in table.items():
+            keys = key if isinstance(key, tuple) else (key,)
+            for code in keys: self._table[code].append(handler)
+
+    def dispatch(self, ev):
+        ''' Calls the handlers for one event.  Returns True if one of them asks
+        for the rest of the batch to be skipped.'''
+        stop = False
+        for handler in self._table[ev]:
+            if handler(ev): stop = True
+        return stop
+
+    def handler_count(self, code):
+        return len(self._table[code])
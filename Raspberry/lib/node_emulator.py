@@ -0,0 +1,233 @@
+#  node_emulator.py -- A stand-in for a node on the comm bus
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Behaves like the node firmware at the frame level, so that the pi
+#  side of the bus protocol can be checked without any hardware.  Frames
+#  go in with handle_frame(), and the reply frame (if any) comes out.
+#  As on the real nodes, the reply is loaded before the frame's command
+#  runs, so what a command does shows up in the reply to the next frame.
+#  PtyBus puts a few of these on a pseudo terminal, that a CommBus can
+#  open in place of a real serial port.
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+import fcntl
+import struct
+import bus_frames
+import bus_speed
+import cmd_pack
+import cfg_plan
+
+CMD_NOP = 0
+CMD_ECHO = 100
+CMD_POLL_DELTA = 104
+CMD_STAMPS = 107
+
+# To read the pi's baud rate off the pty (struct termios2).
+_TCGETS2 = 0x802C542A
+_TERMIOS2_SIZE = 44
+_TERMIOS2_ISPEED = 36
+
+class NodeEmulator():
+    ''' Emulates one node.  nsw is the number of switches, and ibs the number
+    of switch state bytes in the reply, as in the nodes table in hardware.py.
+    rates is the list of bus rates the node can run at.  If stamps is true,
+    the node knows the STAMPS command, as the input nodes do, and once it is
+    turned on, replies end with the latest closure and its age.'''
+    def __init__(self, addr, nsw=0, ibs=0, rates=(bus_speed.BASE_RATE,), stamps=False):
+        self.addr = addr
+        self.nsw = nsw
+        self.ibs = ibs
+        self.rate_mask = bus_speed.mask_for(rates)
+        self.baud = bus_speed.BASE_RATE
+        self._next_baud = None
+        self._t_good = time.monotonic()
+        self._delta_req = False
+        self._seq_req = False
+        self.last_seq = 0
+        self.lose_replies = 0     # Replies to lose, after the frame is taken, to test retries
+        self._last_full = None    # Switch part of the last full reply
+        self._loaded_skip = 0     # Trailing bytes of the loaded reply a delta poll ignores
+        self.cmd_count = 0
+        self.err_count = 0
+        self.echo_reg = 0
+        self.cfg_hash = 0         # Config hash, zero as at power up
+        self.sw_bits = 0
+        self.sw_counts = [0] * nsw
+        self.stamps = stamps
+        self.stamps_on = False
+        self.last_closure = 0xFF
+        self.last_closure_t = 0.0
+        self.executed = []        # Every command executed, in order
+        self._codec = bus_frames.FrameCodec()
+
+    def press(self, isw, n=1):
+        ''' Simulates n closures of switch isw (starting at zero).'''
+        self.sw_counts[isw] = (self.sw_counts[isw] + n) & 0x000F
+        self.last_closure = isw
+        self.last_closure_t = time.monotonic()
+
+    def execute(self, cmd):
+        ''' Executes one plain command.'''
+        self.executed.append(list(cmd))
+        if cmd[0] == CMD_ECHO and len(cmd) > 1: self.echo_reg = cmd[1]
+        if cmd[0] == bus_speed.CMD_GET_RATES: self.echo_reg = self.rate_mask
+        if cmd[0] == cfg_plan.CMD_GET_CFG_HASH and len(cmd) > 1: self.echo_reg = (self.cfg_hash >> (8 * min(cmd[1], 1))) & 0x00FF
+        if cmd[0] == cfg_plan.CMD_SET_CFG_HASH and len(cmd) > 2: self.cfg_hash = (cmd[2] << 8) | cmd[1]
+        if cmd[0] == CMD_STAMPS and len(cmd) > 1 and self.stamps: self.stamps_on = cmd[1] != 0
+        if cmd[0] == bus_speed.CMD_SET_RATE and len(cmd) > 1:
+            rate = bus_speed.rate_from_code(cmd[1])
+            if rate is not None and self.rate_mask & (1 << cmd[1]): self._next_baud = rate
+
+    def tick(self, tnow):
+        ''' Call now and then.  Goes back to the base rate after too long without
+        a good frame on the bus, as the firmware does.'''
+        if self.baud != bus_speed.BASE_RATE and tnow - self._t_good > bus_speed.REVERT_TIME:
+            self.baud = bus_speed.BASE_RATE
+
+    def on_receive(self, dat):
+        ''' Called with the payload of each frame addressed to this node.'''
+        self.cmd_count = (self.cmd_count + 1) & 0x00FF
+        self._delta_req = len(dat) == 1 and dat[0] == CMD_POLL_DELTA
+        # Like the comm_bus library: a SEQ wrapped command is only taken once.
+        self._seq_req = len(dat) >= 2 and dat[0] == cmd_pack.CMD_SEQ
+        if self._seq_req:
+            if dat[1] == self.last_seq: return
+            self.last_seq = dat[1]
+            dat = dat[2:]
+        if len(dat) == 0: return
+        try:
+            cmds = cmd_pack.unpack(dat)
+        except ValueError:
+            self.err_count = (self.err_count + 1) & 0x00FF
+            return
+        for cmd in cmds: self.execute(cmd)
+
+    def load_response(self):
+        ''' Returns the reply payload from the node's state as it is now, laid 
+        out as in the node firmware.'''
+        rsp = [self.cmd_count, self.err_count, self.echo_reg]
+        for i in range(self.ibs): rsp.append((self.sw_bits >> (8 * i)) & 0x00FF)
+        for i in range(0, self.nsw, 2):
+            b = self.sw_counts[i] & 0x000F
+            if i + 1 < self.nsw: b |= (self.sw_counts[i + 1] & 0x000F) << 4
+            rsp.append(b)
+        self._loaded_skip = 0
+        if self.stamps_on:
+            age = int((time.monotonic() - self.last_closure_t) * 1000)
+            rsp.extend([self.last_closure, min(age, 255)])
+            # The age changes all the time, so a delta poll ignores it.
+            self._loaded_skip = 1
+        return rsp
+
+    def send_response(self, rsp):
+        ''' Returns the payload that goes out for a loaded reply, after what the
+        comm_bus library does to it as it is sent.'''
+        if self._seq_req: rsp[2] = self.last_seq
+        # Like the comm_bus library: short reply to a delta poll if nothing's new.
+        n = len(rsp) - self._loaded_skip
+        last = self._last_full
+        if self._delta_req and last is not None and len(last) == len(rsp) - 3 and rsp[3:n] == last[:n - 3]:
+            return rsp[:3]
+        self._last_full = rsp[3:]
+        return rsp
+
+    def handle_frame(self, frame, baud=None):
+        ''' Takes a complete frame from the pi.  Returns the reply frame as
+        bytes, or None if the frame isn't for us or is bad.  If baud is given,
+        and isn't the rate we're at, the frame is garbage to us.'''
+        if baud is not None and baud != self.baud: return None
+        n = len(frame)
+        if n < 3 or frame[0] != bus_frames.SYNC_HOST: return None
+        if (frame[1] & 0x000F) + 3 != n: return None
+        if bus_frames.checksum(frame, n - 1) != frame[n - 1]: return None
+        # Any good frame on the bus keeps us at a faster rate.
+        self._t_good = time.monotonic()
+        addr = (frame[1] >> 4) & 0x000F
+        if addr != self.addr and addr != bus_frames.BROADCAST_ADDR: return None
+        # The firmware loads its reply between frames, and not while it is
+        # answering one, so the reply doesn't show this frame's command.
+        rsp = self.load_response()
+        self.on_receive(frame[2:n - 1])
+        if addr == bus_frames.BROADCAST_ADDR: return None
+        rsp = self.send_response(rsp)
+        if self.lose_replies > 0:
+            self.lose_replies -= 1
+            return None
+        reply = bytearray(self._codec.encode(self.addr, rsp))
+        reply[0] = bus_frames.SYNC_NODE
+        reply[-1] = bus_frames.checksum(reply, len(reply) - 1)
+        if self._next_baud is not None:
+            # Switch once the reply is out.
+            self.baud = self._next_baud
+            self._next_baud = None
+        return bytes(reply)
+
+class PtyBus():
+    ''' A bus segment with emulated nodes on it, made from a pseudo terminal,
+    so the pi side can be run without hardware.  Give port to a CommBus
+    (with tx_enable_pin=None), and the nodes answer from a background thread,
+    about as quickly as the real ones do.  There is no echo of our own
+    frames, as there would be on RS-485.  The pi's baud rate is read from
+    the pty, and nodes at a different rate don't understand it.'''
+    def __init__(self, emulators, reply_delay=0.00075):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._emulators = list(emulators)
+        self._reply_delay = reply_delay
+        self._buf = bytearray()
+        self._run = True
+        self._thread = threading.Thread(target=self._loop, name="pty_bus", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._run = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def pi_baud(self):
+        buf = bytearray(_TERMIOS2_SIZE)
+        fcntl.ioctl(self._slave, _TCGETS2, buf, True)
+        return struct.unpack_from('I', buf, _TERMIOS2_ISPEED)[0]
+
+    def _loop(self):
+        while self._run:
+            r, _, _ = select.select([self._master], [], [], 0.05)
+            tnow = time.monotonic()
+            for em in self._emulators: em.tick(tnow)
+            if len(r) == 0: continue
+            self._buf.extend(os.read(self._master, 256))
+            baud = self.pi_baud()
+            while True:
+                frame = self._next_frame()
+                if frame is None: break
+                for em in self._emulators:
+                    reply = em.handle_frame(frame, baud)
+                    if reply is not None:
+                        time.sleep(self._reply_delay)
+                        os.write(self._master, reply)
+
+    def _next_frame(self):
+        # Takes the next complete frame from the pi off the front of the buffer, 
+        # dropping anything that can't be the start of one.
+        buf = self._buf
+        while len(buf) > 0:
+            if buf[0] != bus_frames.SYNC_HOST:
+                del buf[:1]
+                continue
+            if len(buf) < 2: return None
+            n = (buf[1] & 0x000F) + 3
+            if len(buf) < n: return None
+            frame = bytes(buf[:n])
+            if bus_frames.checksum(frame, n - 1) != frame[n - 1]:
+                del buf[:1]
+                continue
+            del buf[:n]
+            return frame
+        return None
@@ -0,0 +1,36 @@
+#  sw_counts.py -- Decodes the switch hit counters in node replies
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Each input node keeps a 4-bit hit counter per switch, and sends them
+#  packed two to a byte: switch 2n in the low nibble of byte n, and switch
+#  2n+1 in the high nibble.  Counters wrap at 16, so the number of new hits
+#  is the difference mod 16 from the last reply.
+#
+#  Nearly every poll finds nothing new, so the whole counter block is
+#  compared first, and only bytes that changed are taken apart, with a
+#  table instead of shifts and masks.
+
+# Byte -> (low nibble, high nibble)
+NIBBLES = [(b & 0x0F, b >> 4) for b in range(256)]
+
+def count_bytes(nsw):
+    ''' Returns the number of counter bytes for nsw switches.'''
+    return (nsw + 1) // 2
+
+def count_deltas(old, new, nsw):
+    ''' Given the counter bytes from the last reply and this one (as bytes),
+    returns a list of (switch index, new hits) for the switches whose counter
+    moved.  Empty if nothing did.'''
+    moved = []
+    if old == new: return moved
+    for ib in range(len(new)):
+        a = old[ib]
+        b = new[ib]
+        if a == b: continue
+        alo, ahi = NIBBLES[a]
+        blo, bhi = NIBBLES[b]
+        d = (blo - alo) & 0x0F
+        if d != 0: moved.append((2 * ib, d))
+        d = (bhi - ahi) & 0x0F
+        if d != 0 and 2 * ib + 1 < nsw: moved.append((2 * ib + 1, d))
+    return moved
@@ -0,0 +1,104 @@
+#  switch_board.py -- One bitmap of every switch on the machine
+#  Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+#  Each switch has the bit whose position is its event code (see
+#  hw_events.py), so Ev.F4 is bit 0x03, Ev.L1 is bit 0x30, and so on.  The
+#  whole machine fits in one integer.
+#
+#  Node replies are written in as they arrive, by whatever thread polls
+#  the nodes.  Once per game loop, latch() takes a frame: the board as it
+#  is now, and the edges since the last frame, found by XOR.  Queries all
+#  read the frame, so every consumer in a loop sees the same switches,
+#  and none of them need the per-node bitmaps.
+#
+#  The caller does the locking around set_node() and latch().  Queries
+#  don't need it.
+
+import time
+import hw_events
+
+def bit(code):
+    ''' Returns the board bit for a switch code.'''
+    return 1 << code
+
+def mask_for(codes):
+    ''' Returns the board mask for a list of switch codes, or names like "F4".'''
+    m = 0
+    for c in codes:
+        if isinstance(c, str): c = hw_events.code_for_name(c)
+        m |= 1 << c
+    return m
+
+class SwitchBoard():
+    def __init__(self):
+        self._live = 0                  # Written by set_node() as replies come in
+        self._t_change = [0.0] * hw_events.NCODES
+        self.state = 0                  # The board, as of the last latch()
+        self.pressed = 0                # Switches that closed since the latch before
+        self.released = 0               # Switches that opened since the latch before
+        self._node_masks = {d: ((1 << n) - 1) << base for d, (base, n) in hw_events.blocks.items()}
+
+    def set_node(self, designator, bits, t=None):
+        ''' Writes one node's switch bitmap (switch 1 in bit 0) into the board.
+        Switches that changed get t (monotonic time) as their time of change.'''
+        base, _ = hw_events.blocks[designator]
+        m = self._node_masks[designator]
+        new = (self._live & ~m) | ((bits << base) & m)
+        changed = new ^ self._live
+        if changed == 0: return
+        if t is None: t = time.monotonic()
+        while changed:
+            low = changed & -changed
+            self._t_change[low.bit_length() - 1] = t
+            changed ^= low
+        self._live = new
+
+    def latch(self):
+        ''' Takes a new frame.  Returns the mask of switches that changed.'''
+        old = self.state
+        new = self._live
+        changed = old ^ new
+        self.pressed = changed & new
+        self.released = changed & old
+        self.state = new
+        return changed
+
+    def closed(self, code):
+        return (self.state >> code) & 1 == 1
+
+    def was_pressed(self, code):
+        return (self.pressed >> code) & 1 == 1
+
+    def was_released(self, code):
+        return (self.released >> code) & 1 == 1
+
+    def changed(self, mask):
+        ''' Returns true if any switch in the mask changed in this frame.'''
+        return (self.pressed | self.released) & mask != 0
+
+    def bits(self, code, n):
+        ''' Returns the states of n switches starting at code, shifted down to bit 0.'''
+        return (self.state >> code) & ((1 << n) - 1)
+
+    def node_bits(self, designator):
+        ''' Returns one node's bitmap, as the node sends it.'''
+        base, _ = hw_events.blocks[designator]
+        return (self.state & self._node_masks[designator]) >> base
+
+    def count(self, mask):
+        ''' Returns the number of closed switches in the mask.'''
+        return bin(self.state & mask).count("1")
+
+    def last_change(self, code):
+        ''' Returns when (monotonic time) the switch last changed, or zero if it
+        never has.'''
+        return self._t_change[code]
+
+    def last_change_in(self, mask):
+        ''' Returns the latest time any switch in the mask changed.'''
+        t = 0.0
+        while mask:
+            low = mask & -mask
+            t = max(t, self._t_change[low.bit_length() - 1])
+            mask ^= low
+        return t
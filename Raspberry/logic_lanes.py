@@ -8,6 +8,7 @@ import sound_manager as sm
 import config
 import random_choice as rc
 import neo_colors as cc
+from hw_events import Ev
 
 class LogicLanes():
     def __init__(self, app, hw, sound, lights):
@@ -79,41 +80,58 @@ class LogicLanes():
         self._sound.play(sm.S_LANE_AWARD)
         self.set_score_lights()                    
 
-    def process_hw_event(self, ev):
-        ''' Process hardware events that might impact lanes.'''
+    def hw_handlers(self):
+        ''' Returns the dispatch table for the hardware events that might impact lanes.'''
+        return {Ev.F1: self.on_right_flipper,
+                Ev.F2: self.on_left_flipper,
+                Ev.L1: self.on_easy_lane,
+                Ev.L5: self.on_side_lane,
+                (Ev.L2, Ev.L3, Ev.L4): self.on_top_lane,
+                (Ev.L7, Ev.L10): self.on_flipper_lane,
+                (Ev.L8, Ev.L9): self.on_drain_lane}
+
+    def on_right_flipper(self, ev):
+        if not self._app.game_active(): return
+        self._hot_lane += 1 
+        if self._hot_lane >= 3: self._hot_lane = 0 
+        self.set_hot_lights()
+
+    def on_left_flipper(self, ev):
+        if not self._app.game_active(): return
+        self._hot_lane -= 1 
+        if self._hot_lane < 0: self._hot_lane = 2 
+        self.set_hot_lights()
+
+    def on_easy_lane(self, ev):
+        if not self._app.game_active(): return
+        points = config.get_points("easy_lane", 25)
+        self._sound.play(sm.S_DING_LANE)
+        self._app.add_to_score(points)
+
+    def on_side_lane(self, ev):
         if not self._app.game_active(): return
-        if ev == "F1":  # Right Flipper Button
-            self._hot_lane += 1 
-            if self._hot_lane >= 3: self._hot_lane = 0 
-            self.set_hot_lights()
-        if ev == "F2":  # Left Flipper Button
-            self._hot_lane -= 1 
-            if self._hot_lane < 0: self._hot_lane = 2 
-            self.set_hot_lights()
-        if ev == "L1":  # Easy Lane
-            points = config.get_points("easy_lane", 25)
-            self._sound.play(sm.S_DING_LANE)
-            self._app.add_to_score(points)
-        if ev == "L5":  # Side Lane
-            self._side_hits += 1
-            points = config.get_points("side_lane", 500)
-            self._app.add_to_score(points * self._side_hits)
-            self._sound.play(sm.S_WIN_TRUMPET_2)
-            self.set_side_lane_lights()
-        if ev == "L4": # Upper lane left
-            self.process_top_lane(0) 
-        if ev == "L3": # Upper lane middle
-            self.process_top_lane(1) 
-        if ev == "L2": # Upper Lane right
-            self.process_top_lane(2)
-        if ev in ["L7", "L10"]: # Flipper Lanes
-            points = config.get_points("flipper_lanes", 50)
-            self._sound.play(sm.S_DING_LANE)
-        if ev in ["L8", "L9"]:  # Drain Lanes
-            isc  = self._fouls.get()
-            self._sound.play(isc)
-            points = config.get_points("drain_lanes", 25)
-            self._app.add_to_score(points)
+        self._side_hits += 1
+        points = config.get_points("side_lane", 500)
+        self._app.add_to_score(points * self._side_hits)
+        self._sound.play(sm.S_WIN_TRUMPET_2)
+        self.set_side_lane_lights()
+
+    def on_top_lane(self, ev):
+        # L4 is the upper lane left, L3 the middle, and L2 the right.
+        if not self._app.game_active(): return
+        self.process_top_lane(Ev.L4 - ev) 
+
+    def on_flipper_lane(self, ev):
+        if not self._app.game_active(): return
+        points = config.get_points("flipper_lanes", 50)
+        self._sound.play(sm.S_DING_LANE)
+
+    def on_drain_lane(self, ev):
+        if not self._app.game_active(): return
+        isc  = self._fouls.get()
+        self._sound.play(isc)
+        points = config.get_points("drain_lanes", 25)
+        self._app.add_to_score(points)
 
 
 
@@ -9,6 +9,7 @@ import sound_manager as sm
 import config
 import random_choice as rc
 import neo_colors as cc
+from hw_events import Ev
 
 possible_panics = rc.RandomChoice([
         (13, sm.S_PANIC_2),    # "Panic_CAD_Not_Ready.wav"),
@@ -229,22 +230,21 @@ class LogicPanic():
         if self._mode == MODE_ADDING_POINTS:
             self.manage_adding_points()
         
-    def process_hw_event(self, ev):
-        ''' Process hardware events that might impact lanes.'''
+    def hw_handlers(self):
+        ''' Returns the dispatch table for the hardware events that matter to panic mode.'''
+        return {Ev.T5: self.on_panic_target,
+                (Ev.T1, Ev.T2, Ev.T3, Ev.T4, Ev.T6): self.on_bonus_hit,
+                (Ev.K1, Ev.K2, Ev.K3, Ev.B1, Ev.B2, Ev.B3): self.on_bonus_hit,
+                (Ev.L1, Ev.L2, Ev.L3, Ev.L4, Ev.L5, Ev.L6, Ev.L7, Ev.L8, Ev.L9, Ev.L10): self.on_bonus_hit}
+
+    def on_panic_target(self, ev):
+        if not self._app.game_active(): return
+        self.panic_hit()
+
+    def on_bonus_hit(self, ev):
         if not self._app.game_active(): return
-        if ev == "T5":
-            self.panic_hit()
-            return
         if not self._inpanic: return
-        if ev in ["T1", "T2", "T3", "T4", "T6"]:
-            self.add_bonus()
-            return
-        if ev in ["K1", "K2", "K3", "B1", "B2", "B3"]:
-            self.add_bonus()
-            return
-        if ev in ["L1", "L2", "L3", "L4", "L5", "L6", "L7", "L8", "L9", "L10"]:
-            self.add_bonus()
-            return
+        self.add_bonus()
             
     
 
@@ -7,6 +7,7 @@ import playfield_lights as pl
 import sound_manager as sm
 import config
 import neo_colors as cc
+from hw_events import Ev
 
 EPIC_TARGETS_POINTS = [250, 300, 350, 500]
 
@@ -70,25 +71,24 @@ class LogicTargets():
             self._sound.play(sm.S_DING_TARGET)
         self.set_epic_target_lights()
 
-    def process_hw_event(self, ev):
-        ''' Process hardware events pretainting to targets.'''
+    def hw_handlers(self):
+        ''' Returns the dispatch table for the hardware events pretainting to targets.'''
+        return {(Ev.T1, Ev.T2, Ev.T3, Ev.T4): self.on_epic_target,   # Targets E, P, I, C
+                Ev.T6: self.on_x_target}
+
+    def on_epic_target(self, ev):
         if not self._app.game_active(): return
-        if ev == "T1":  # Target E 
-            self.process_epic_hit(0)
-        if ev == "T2":  # Target P 
-            self.process_epic_hit(1)
-        if ev == "T3":  # Target I 
-            self.process_epic_hit(2)
-        if ev == "T4":  # Target C 
-            self.process_epic_hit(3)
-        if ev == "T6":  # X Target
-            self._xtarg_hits += 1
-            self._lights.set_pixel(pl.PI_TARG_X, cc.RED)
-            base_points = config.get_points("target_x", 750)
-            points = base_points * self._xtarg_hits
-            self._app.add_to_score(points) 
-            log(f"X target hit. {points} awarded.")
-            self._sound.play(sm.S_DING_TARGET)
+        self.process_epic_hit(ev - Ev.T1)
+
+    def on_x_target(self, ev):
+        if not self._app.game_active(): return
+        self._xtarg_hits += 1
+        self._lights.set_pixel(pl.PI_TARG_X, cc.RED)
+        base_points = config.get_points("target_x", 750)
+        points = base_points * self._xtarg_hits
+        self._app.add_to_score(points) 
+        log(f"X target hit. {points} awarded.")
+        self._sound.play(sm.S_DING_TARGET)
         
         
 
@@ -116,7 +116,7 @@ class PlayfieldLights():
 
     def issue_cmd(self, *cmd):
         ''' Send a command for this node.  Log the command as well'''
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         tell_log(cmd)
 
     def queue_startup_cmds(self):
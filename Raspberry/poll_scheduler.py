@@ -0,0 +1,109 @@
+# Pinball Machine Project, EPIC Robotz, Fall 2022
+#
+# poll_scheduler.py -- Decides which nodes get talked to on each
+# pass through Hardware.update().
+#
+# A scheduler has three methods:
+#   next_pass(nodes, tnow)  -- returns a list of node addresses to visit, in order
+#   on_visit(addr, nevents, tnow) -- called after each visit, with the number of new events
+#   report()  -- returns a map of stats since the last report, for the log
+#
+
+import time
+
+class RoundRobinScheduler():
+    ''' Visits every node once per pass, in order.  This is how
+    the hardware was polled originally.'''
+    def __init__(self):
+        self._visits = {}
+        self._t0 = time.monotonic()
+
+    def next_pass(self, nodes, tnow):
+        return list(nodes)
+
+    def on_visit(self, addr, nevents, tnow):
+        self._visits[addr] = self._visits.get(addr, 0) + 1
+
+    def report(self):
+        rp = rates_report(self._visits, self._t0)
+        self._visits = {}
+        self._t0 = time.monotonic()
+        return rp
+
+class WeightedScheduler():
+    ''' Visits each input node at about its target rate, in order of priority
+    (lowest number first).  Nodes with no switches are visited only when they
+    have commands waiting.  A node that has just reported switch activity gets
+    its rate multiplied by boost for boost_time seconds, since more action
+    usually follows.  When passes come slower than a node's rate, it is visited
+    more than once in a pass, up to max_visits times, so that its rate isn't
+    capped by how often update() is called.'''
+    def __init__(self, rates, priorities, boost=2.0, boost_time=2.0, max_visits=4):
+        self._rates = rates
+        self._priorities = priorities
+        self._boost = boost
+        self._boost_time = boost_time
+        self._max_visits = max_visits
+        self._credits = {}
+        self._last_activity = {}
+        self._tlast = None       # Set on the first pass, so no credit builds up before it
+        self._visits = {}
+        self._t0 = time.monotonic()
+
+    def next_pass(self, nodes, tnow):
+        if self._tlast is None: self._tlast = tnow
+        dt = tnow - self._tlast
+        self._tlast = tnow
+        nvisits = {}
+        for addr in nodes:
+            node = nodes[addr]
+            if node.switch_count() == 0:
+                if node.queue_depth() > 0: nvisits[addr] = 1
+                continue
+            rate = self._rates.get(addr, 50)
+            if tnow - self._last_activity.get(addr, -1000.0) < self._boost_time:
+                rate *= self._boost
+            credit = self._credits.get(addr, 1.0) + rate * dt
+            if credit > self._max_visits: credit = self._max_visits
+            n = int(credit)
+            if n == 0 and node.queue_depth() > 0: n = 1
+            if n > 0:
+                credit -= n
+                if credit < 0.0: credit = 0.0
+                nvisits[addr] = n
+            self._credits[addr] = credit
+        # Spread repeat visits over the pass: every due node once, in priority
+        # order, then the ones due twice, and so on.
+        order = sorted(nvisits, key=lambda a: self._priorities.get(a, 99))
+        due = []
+        for k in range(max(nvisits.values(), default=0)):
+            for addr in order:
+                if nvisits[addr] > k: due.append(addr)
+        return due
+
+    def on_visit(self, addr, nevents, tnow):
+        self._visits[addr] = self._visits.get(addr, 0) + 1
+        if nevents > 0: self._last_activity[addr] = tnow
+
+    def report(self):
+        rp = rates_report(self._visits, self._t0)
+        self._visits = {}
+        self._t0 = time.monotonic()
+        return rp
+
+def rates_report(visits, t0):
+    ''' Returns the achieved visits per second for each node, since t0.'''
+    rp = {}
+    telp = time.monotonic() - t0
+    if telp <= 0: return rp
+    for addr in sorted(visits):
+        rp[f"Node {addr} Polls/s"] = f"{visits[addr] / telp:.1f}"
+    return rp
+
+def make_scheduler(kind, rates=None, priorities=None, boost=2.0, boost_time=2.0, max_visits=4):
+    ''' Returns a scheduler given its name: "round_robin" or "weighted".'''
+    if kind == "weighted":
+        if rates is None: rates = {}
+        if priorities is None: priorities = {}
+        return WeightedScheduler(rates, priorities, boost, boost_time, max_visits)
+    return RoundRobinScheduler()
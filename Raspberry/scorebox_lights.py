@@ -46,29 +46,29 @@ class ScoreBoxLights():
     def on_game_mode(self):
         '''Normal name mode: Fast Wipe'''
         cmd = [CMD_NEO_WIPE, 0, 255, 0, 0, 0, 0, 1] # NEO_WIPE green/black 25ms period
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Ligths: NeoWipe green/black 25ms.")
         cmd = [CMD_LAMP_MODULATE, 0b00101010, 0, 200, 50]
-        self._hw.send_command(self._nodeadr, cmd) 
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC) 
         cmd = [CMD_LAMP_MODULATE, 0b00010101, 0, 200, 60]
-        self._hw.send_command(self._nodeadr, cmd) 
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC) 
         log("SBox Lamps: modulate quickly")
 
     def on_wait_mode(self):
         '''Normal name mode: Fast Wipe'''
         cmd = [CMD_NEO_DEMO] 
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox NeoPixels: NeoDemo")
         cmd = [CMD_LAMP_MODULATE, 0b00101010, 0, 200, 255]
-        self._hw.send_command(self._nodeadr, cmd) 
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC) 
         cmd = [CMD_LAMP_MODULATE, 0b00010101, 0, 200, 235]
-        self._hw.send_command(self._nodeadr, cmd) 
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC) 
         log("SBox Lamps: modulate slowly")  
 
     def on_game_over(self):
         '''All Red for 15 seconds, Lamps off.'''
         cmd = [CMD_NEO_SOLID, 255, 0, 0]
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Ligths: all red.")
         ev = {'cmd': "wait_mode", 'cmd_name': "Wait Mode Lights"}
         self._queue.add_event(ev, 15.0)
@@ -77,10 +77,10 @@ class ScoreBoxLights():
         '''Twinkle white for 5 second, then demo'''
         self._queue.clear_events()
         cmd = [CMD_NEO_BLINK, 255, 255, 255, 0, 0, 0, 2, 2, 2]  # NEO_BLINK white/black 2-piels, 50ms period
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Ligths: NeoBlink white/black, 2px/2px, 50ms")
         cmd = [CMD_LAMP_SOLID, 0x3F, 255] 
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Lamps: all on")
         ev = {'cmd': "game_mode", 'cmd_name': "Game Mode Lights"}
         self._queue.add_event(ev, 5.0)
@@ -89,10 +89,10 @@ class ScoreBoxLights():
         '''Twinkle blue for 5 seconds, Flash Lamps'''
         self._queue.clear_events()
         cmd = [CMD_NEO_BLINK, 0, 0, 255, 255, 0, 0, 3, 3, 2]  # NEO_BLINK blue/red 3-piels, 50ms period
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Ligths: NeoBlink blue/red, 3px/3px, 50ms")
         cmd = [CMD_LAMP_SOLID, 0x3F, 255] 
-        self._hw.send_command(self._nodeadr, cmd)
+        self._hw.send_command(self._nodeadr, cmd, hardware.PRI_COSMETIC)
         log("SBox Lamps: all on")
         ev = {'cmd': "game_mode", 'cmd_name': "Game Mode Lights"}
         self._queue.add_event(ev, 5.0)